@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_bf16.py - bf16 Autocast vs fp32 on CPU
+Trains every CPU config of config_cpu.py twice from the same seed (fp32, then cpu_bf16=True) and reports
+the accuracy delta (exact full-pass val loss) and the training / generation speedup of bf16
+Only meaningful on CPUs with native bf16 (AVX512-BF16 or AMX), elsewhere cpu_bf16 falls back to fp32
+"""
+
+import io
+import time
+from contextlib import nullcontext, redirect_stdout
+from dataclasses import replace
+
+import torch
+
+from config_cpu import (CONFIG_ULTRA_TINY, CONFIG_TINY_CPU, CONFIG_SMALL_CPU, CONFIG_MEDIUM_CPU, CONFIG_LARGE_CPU,
+                        get_sample_text)
+from train import create_tiny_dataset_from_text, train_slm, evaluate_full, cpu_autocast, cpu_bf16_supported
+
+# ============================================================================
+# BENCHMARK CONFIGURATION
+# ============================================================================
+
+# (name, config, sample text multiplier) as in cpu_experiment_5levels.py
+CONFIGS = [
+    ("ULTRA_TINY", CONFIG_ULTRA_TINY, 1),
+    ("TINY_CPU", CONFIG_TINY_CPU, 2),
+    ("SMALL_CPU", CONFIG_SMALL_CPU, 5),
+    ("MEDIUM_CPU", CONFIG_MEDIUM_CPU, 15),
+    ("LARGE_CPU", CONFIG_LARGE_CPU, 50),
+]
+MAX_ITERS = 200  # per run, capped so the whole table finishes in minutes
+GEN_PROMPT_TOKENS = 8
+GEN_NEW_TOKENS = 16
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def time_generation(model, bf16):
+    """Greedy KV-cached tokens/s from a fixed random prompt"""
+    torch.manual_seed(0)
+    context = torch.randint(0, model.config.vocab_size, (1, GEN_PROMPT_TOKENS))
+    new_tokens = min(GEN_NEW_TOKENS, model.config.block_size - GEN_PROMPT_TOKENS)
+    with torch.no_grad(), cpu_autocast(bf16):
+        model.generate(context, max_new_tokens=2, temperature=0)  # warm-up
+        start_time = time.perf_counter()
+        model.generate(context, max_new_tokens=new_tokens, temperature=0)
+    return new_tokens / (time.perf_counter() - start_time)
+
+
+def run_config(config, multiplier):
+    """Train fp32 and bf16 from the same seed; val losses are exact full passes, each in its own precision"""
+    config = replace(config, max_iters=min(config.max_iters, MAX_ITERS), eval_mode='full')
+    results = {}
+    for bf16 in (False, True):
+        mode_config = replace(config, cpu_bf16=bf16)
+        with redirect_stdout(io.StringIO()):  # keep the table readable, train_slm is chatty
+            train_data, val_data, tokenizer = create_tiny_dataset_from_text(get_sample_text(multiplier), mode_config)
+            model, _ = train_slm(mode_config, train_data, val_data, tokenizer)
+        model.eval()
+        results[bf16] = {
+            'val_loss': evaluate_full(model, val_data, mode_config, 'cpu', cpu_autocast(bf16))['loss'],
+            'val_loss_fp32_eval': evaluate_full(model, val_data, mode_config, 'cpu', nullcontext())['loss'],
+            'train_tokens_per_sec': model.training_stats['tokens_per_sec'],
+            'gen_tokens_per_sec': time_generation(model, bf16),
+        }
+    return results
+
+
+def main():
+    print("="*70)
+    print("🧮 BF16 AUTOCAST vs FP32 ON CPU")
+    print("="*70)
+    print(f"   Native bf16 (AVX512-BF16/AMX): {cpu_bf16_supported()}")
+    print(f"   Threads: {torch.get_num_threads()}, iterations per run: <= {MAX_ITERS}")
+
+    run_config(CONFIGS[0][1], CONFIGS[0][2])  # warm-up, otherwise the first fp32 run pays the process's one-off costs
+    rows = []
+    for name, config, multiplier in CONFIGS:
+        print(f"   Training {name} (fp32, bf16)...")
+        rows.append((name, run_config(config, multiplier)))
+
+    print(f"\n{'Config':<12} {'Val fp32':<10} {'Val bf16':<10} {'Delta':<9} {'Delta*':<9} "
+          f"{'Train speedup':<15} {'Gen speedup':<12}")
+    print("-"*80)
+    for name, results in rows:
+        fp32, bf16 = results[False], results[True]
+        print(f"{name:<12} {fp32['val_loss']:<10.4f} {bf16['val_loss']:<10.4f} "
+              f"{bf16['val_loss'] - fp32['val_loss']:<+9.4f} {bf16['val_loss_fp32_eval'] - fp32['val_loss']:<+9.4f} "
+              f"{bf16['train_tokens_per_sec'] / fp32['train_tokens_per_sec']:<15.2f} "
+              f"{bf16['gen_tokens_per_sec'] / fp32['gen_tokens_per_sec']:<12.2f}")
+    print("="*80)
+    print("   Delta : bf16-trained model evaluated under bf16 autocast, minus fp32")
+    print("   Delta*: bf16-trained model evaluated in fp32 (training effect only), minus fp32")
+
+
+if __name__ == "__main__":
+    main()
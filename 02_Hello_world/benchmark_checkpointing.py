@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_checkpointing.py - Activation Checkpointing: Memory vs Step Time
+Trains CONFIG_LARGE_GPU of config_cpu.py on random batches with activation_checkpointing off,
+every 2nd Block and every Block, each mode in a fresh process so peak RSS belongs to that mode alone
+(Unix only: peak RSS comes from resource.getrusage)
+"""
+
+import sys
+import json
+import time
+import resource
+import subprocess
+from dataclasses import replace
+
+import torch
+
+from config_cpu import CONFIG_LARGE_GPU
+from train import TinyGPT, make_optimizer
+
+# ============================================================================
+# BENCHMARK CONFIGURATION
+# ============================================================================
+
+BENCH_CONFIG = CONFIG_LARGE_GPU
+MODES = [0, 2, 1]  # activation_checkpointing values: off, every 2nd Block, every Block
+TRAIN_STEPS = 10   # after one warm-up step
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux reports KiB
+
+
+def run_mode(checkpoint_every):
+    """Forward, backward and AdamW steps at the config's batch shape -> stats dict (runs in its own process)"""
+    config = replace(BENCH_CONFIG, activation_checkpointing=checkpoint_every)
+    torch.manual_seed(config.seed)
+    model = TinyGPT(config)
+    optimizer = make_optimizer(model, config)
+    model_rss = peak_rss_mb()
+
+    shape = (config.batch_size, config.block_size)
+    times = []
+    for _ in range(TRAIN_STEPS + 1):
+        X = torch.randint(0, config.vocab_size, shape)
+        Y = torch.randint(0, config.vocab_size, shape)
+        start_time = time.perf_counter()
+        _, loss = model(X, Y)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        times.append(time.perf_counter() - start_time)
+    return {'mode': checkpoint_every, 'model_rss_mb': model_rss, 'peak_rss_mb': peak_rss_mb(),
+            'step_ms': sum(times[1:]) / TRAIN_STEPS * 1000}
+
+
+def launch(checkpoint_every):
+    """Run one mode in a fresh interpreter, its last stdout line is the stats JSON"""
+    output = subprocess.run([sys.executable, __file__, str(checkpoint_every)], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    print("="*70)
+    print("🧠 ACTIVATION CHECKPOINTING BENCHMARK")
+    print("="*70)
+    print(f"   CONFIG_LARGE_GPU: {BENCH_CONFIG.n_layer} layers, n_embd {BENCH_CONFIG.n_embd}, "
+          f"batch {BENCH_CONFIG.batch_size} x block {BENCH_CONFIG.block_size}")
+    print(f"   Threads: {torch.get_num_threads()}, steps per mode: {TRAIN_STEPS}")
+
+    rows = [launch(mode) for mode in MODES]
+    base = rows[0]
+    labels = {0: "off", 1: "every Block", 2: "every 2nd Block"}
+    print(f"\n{'Checkpointing':<16} {'Peak RSS (MB)':<15} {'Training (MB)':<15} {'Step (ms)':<11} {'Step time':<10}")
+    print("-"*70)
+    for row in rows:
+        training_mb = row['peak_rss_mb'] - row['model_rss_mb']
+        slowdown = row['step_ms'] / base['step_ms']
+        print(f"{labels[row['mode']]:<16} {row['peak_rss_mb']:<15,.0f} {training_mb:<15,.0f} {row['step_ms']:<11.1f} "
+              f"{f'{slowdown:.2f}x':<10}")
+    print("="*70)
+    print("   Training (MB): peak RSS minus RSS after building the model (activations, gradients, AdamW state)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print(json.dumps(run_mode(int(sys.argv[1]))))
+    else:
+        main()
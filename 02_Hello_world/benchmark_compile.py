@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_compile.py - torch.compile vs Eager
+Training step (forward, backward, AdamW) and KV-cached decoding of a CONFIG_MEDIUM TinyGPT
+Records compile time, steady-state step time and first-token latency; "warm cache" rows recompile
+after torch._dynamo.reset(), i.e. what the next run of a script pays with the on-disk cache
+"""
+
+import time
+import torch
+
+from config import CONFIG_MEDIUM
+from train import TinyGPT, make_optimizer, enable_compile_cache, compile_decode_step, COMPILE_CACHE_DIR
+
+# ============================================================================
+# BENCHMARK CONFIGURATION
+# ============================================================================
+
+BENCH_CONFIG = CONFIG_MEDIUM
+TRAIN_STEPS = 30
+PROMPT_LENGTHS = [4, 7, 11]  # one compiled decode graph must serve all of them
+MAX_NEW_TOKENS = 20          # prompt + new tokens stay within block_size: every step after the first is a decode
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def new_model():
+    torch.manual_seed(BENCH_CONFIG.seed)
+    return TinyGPT(BENCH_CONFIG)
+
+
+def time_train_steps(model, step_model, steps=TRAIN_STEPS):
+    """(first step incl. any compile, mean steady-state step) in seconds, on fixed-shape random batches"""
+    optimizer = make_optimizer(model, BENCH_CONFIG)
+    shape = (BENCH_CONFIG.batch_size, BENCH_CONFIG.block_size)
+    times = []
+    for _ in range(steps + 1):
+        X = torch.randint(0, BENCH_CONFIG.vocab_size, shape)
+        Y = torch.randint(0, BENCH_CONFIG.vocab_size, shape)
+        start_time = time.perf_counter()
+        _, loss = step_model(X, Y)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        times.append(time.perf_counter() - start_time)
+    return times[0], sum(times[1:]) / steps
+
+
+def time_decode(model, contexts):
+    """(first generate() call incl. any compile, first-token latency, per-token decode time) in seconds"""
+    with torch.no_grad():
+        start_time = time.perf_counter()
+        model.generate(contexts[0], max_new_tokens=MAX_NEW_TOKENS, temperature=0)
+        first_call = time.perf_counter() - start_time
+
+        first_token, decode = 0.0, 0.0
+        for context in contexts:
+            start_time = time.perf_counter()
+            model.generate(context, max_new_tokens=1, temperature=0)
+            prefill = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            model.generate(context, max_new_tokens=MAX_NEW_TOKENS, temperature=0)
+            full = time.perf_counter() - start_time
+            first_token += prefill
+            decode += (full - prefill) / (MAX_NEW_TOKENS - 1)
+    return first_call, first_token / len(contexts), decode / len(contexts)
+
+
+def main():
+    print("="*70)
+    print("⚙️  TORCH.COMPILE BENCHMARK")
+    print("="*70)
+    enable_compile_cache()
+    print(f"   Compile cache: {COMPILE_CACHE_DIR} (run twice: the second run starts from a warm cache)")
+    print(f"   Threads: {torch.get_num_threads()}")
+
+    # Training step: the same model object, eager then compiled
+    train_rows = []
+    model = new_model()
+    train_rows.append(("eager",) + time_train_steps(model, model))
+    model = new_model()
+    train_rows.append(("compiled",) + time_train_steps(model, torch.compile(model)))
+    torch._dynamo.reset()
+    model = new_model()
+    train_rows.append(("compiled (warm cache)",) + time_train_steps(model, torch.compile(model)))
+
+    # Decoding: prompts of several lengths, greedy so eager and compiled produce the same tokens
+    contexts = [torch.randint(0, BENCH_CONFIG.vocab_size, (1, length)) for length in PROMPT_LENGTHS]
+    decode_rows = []
+    model = new_model().eval()
+    decode_rows.append(("eager",) + time_decode(model, contexts))
+    decode_rows.append(("compiled",) + time_decode(compile_decode_step(new_model().eval()), contexts))
+    torch._dynamo.reset()
+    decode_rows.append(("compiled (warm cache)",) + time_decode(compile_decode_step(new_model().eval()), contexts))
+
+    eager_step = train_rows[0][2]
+    print(f"\n{'Train step':<24} {'First step (s)':<16} {'Step (ms)':<12} {'Speedup':<8}")
+    print("-"*70)
+    for mode, first, step in train_rows:
+        print(f"{mode:<24} {first:<16.2f} {step * 1000:<12.2f} {f'{eager_step / step:.2f}x':<8}")
+
+    eager_decode = decode_rows[0][3]
+    print(f"\n{'Decode':<24} {'First call (s)':<16} {'First tok (ms)':<16} {'Tok (ms)':<10} {'Speedup':<8}")
+    print("-"*70)
+    for mode, first_call, first_token, decode in decode_rows:
+        print(f"{mode:<24} {first_call:<16.2f} {first_token * 1000:<16.2f} {decode * 1000:<10.2f} "
+              f"{f'{eager_decode / decode:.2f}x':<8}")
+
+    print("="*70)
+    print(f"   batch {BENCH_CONFIG.batch_size} x block {BENCH_CONFIG.block_size} for training, "
+          f"prompts of {PROMPT_LENGTHS} tokens + {MAX_NEW_TOKENS} new for decoding")
+
+
+if __name__ == "__main__":
+    main()
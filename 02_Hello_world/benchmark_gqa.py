@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_gqa.py - Grouped-query / Multi-query Attention: KV Cache Size vs Decode Throughput
+Builds CONFIG_LARGE_GPU of config_cpu.py (8 heads) with n_kv_head = 1, 2 and n_head at a long context,
+prefills a batch of 32 prompts and times greedy KV-cached decode steps, through F.scaled_dot_product_attention
+and through the masked-matmul fallback (used when torch has no SDPA)
+Weights are random: throughput and memory depend on the shapes only
+"""
+
+import io
+import time
+from contextlib import redirect_stdout
+from dataclasses import replace
+
+import torch
+
+from config_cpu import CONFIG_LARGE_GPU
+from train import TinyGPT, KVCache
+
+# ============================================================================
+# BENCHMARK CONFIGURATION
+# ============================================================================
+
+BENCH_CONFIG = replace(CONFIG_LARGE_GPU, block_size=512, dropout=0.0)  # long context: the cache is what grows
+KV_HEADS = [1, 2, BENCH_CONFIG.n_head]
+BATCH_SIZE = 32
+PROMPT_TOKENS = 256
+DECODE_STEPS = 128  # timed, after two warm-up steps
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def use_manual_attention(model):
+    """Switch every Block to the masked-matmul path, the one taken when F.scaled_dot_product_attention is missing"""
+    block_size = model.config.block_size
+    for block in model.transformer.h:
+        block.attn.flash = False
+        block.attn.register_buffer("bias", torch.tril(torch.ones(block_size, block_size))
+                                   .view(1, 1, block_size, block_size))
+
+
+def cache_mb(kv_cache):
+    return sum(t.numel() * t.element_size() for t in kv_cache.k + kv_cache.v) / 2**20
+
+
+def time_decode(model):
+    """Prefill BATCH_SIZE random prompts, then greedy decode steps -> (cache MB, decode tokens/s)"""
+    torch.manual_seed(0)
+    idx = torch.randint(0, model.config.vocab_size, (BATCH_SIZE, PROMPT_TOKENS))
+    kv_cache = KVCache(model.config, BATCH_SIZE, 'cpu')
+    idx_next = model.prefill(idx, kv_cache).argmax(dim=-1)
+    for _ in range(2):
+        idx_next = model.decode_step(idx_next, kv_cache).argmax(dim=-1)
+    start_time = time.perf_counter()
+    for _ in range(DECODE_STEPS):
+        idx_next = model.decode_step(idx_next, kv_cache).argmax(dim=-1)
+    elapsed = time.perf_counter() - start_time
+    return cache_mb(kv_cache), BATCH_SIZE * DECODE_STEPS / elapsed
+
+
+def run_kv_heads(n_kv_head):
+    """{path: (cache MB, tokens/s)} and the parameter count for one n_kv_head"""
+    config = replace(BENCH_CONFIG, n_kv_head=n_kv_head)
+    torch.manual_seed(config.seed)
+    with redirect_stdout(io.StringIO()):  # TinyGPT announces its size
+        model = TinyGPT(config).eval()
+    results = {'sdpa': time_decode(model)}
+    use_manual_attention(model)
+    results['manual'] = time_decode(model)
+    return results, model.param_count
+
+
+def main():
+    print("="*70)
+    print("🗝️  GROUPED-QUERY ATTENTION: KV CACHE vs DECODE THROUGHPUT")
+    print("="*70)
+    print(f"   CONFIG_LARGE_GPU: {BENCH_CONFIG.n_layer} layers, {BENCH_CONFIG.n_head} heads, "
+          f"n_embd {BENCH_CONFIG.n_embd}, block {BENCH_CONFIG.block_size}")
+    print(f"   Batch {BATCH_SIZE}, prompt {PROMPT_TOKENS} tokens, {DECODE_STEPS} decode steps, "
+          f"threads: {torch.get_num_threads()}")
+
+    rows = [(n_kv_head, *run_kv_heads(n_kv_head)) for n_kv_head in KV_HEADS]
+    base_sdpa, base_manual = rows[-1][1]['sdpa'][1], rows[-1][1]['manual'][1]
+    print(f"\n{'n_kv_head':<11} {'Params':<12} {'Cache (MB)':<12} {'SDPA tok/s':<12} {'Speedup':<9} "
+          f"{'Manual tok/s':<14} {'Speedup':<9}")
+    print("-"*80)
+    for n_kv_head, results, param_count in rows:
+        (cache, sdpa), (_, manual) = results['sdpa'], results['manual']
+        print(f"{n_kv_head:<11} {param_count:<12,} {cache:<12.1f} {sdpa:<12,.0f} {f'{sdpa / base_sdpa:.2f}x':<9} "
+              f"{manual:<14,.0f} {f'{manual / base_manual:.2f}x':<9}")
+    print("="*80)
+    print(f"   Cache: fp32 keys + values for all {BENCH_CONFIG.block_size} positions, all layers; "
+          "speedups vs n_kv_head = n_head")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 import os
+from contextlib import nullcontext
 from dataclasses import dataclass
 import numpy as np
 
+from sampling import Sampler, StopSequences
+from vocab import CompactVocab
+
 # ============================================================================
 # PART 1: TRAIN ON CLOUD (Google Colab / Kaggle / AWS)
 # ============================================================================
@@ -62,6 +66,32 @@ def save_model_for_laptop(model, filename="slm_model.pt"):
 # PART 2: MODEL ARCHITECTURE (Same as train.py - needed for loading)
 # ============================================================================
 
+# F.scaled_dot_product_attention shares K/V heads across query groups itself from torch 2.5 (enable_gqa)
+SDPA_GQA = tuple(int(part) for part in torch.__version__.split('.')[:2]) >= (2, 5)
+
+class KVCache:
+    """
+    Per-layer key/value buffers for incremental decoding
+    Prefill writes the whole prompt once, each decode step appends one position
+    Holds n_kv_head heads per layer, so grouped-query models cache n_head // n_kv_head times less
+    """
+    def __init__(self, config, batch_size, device, dtype=torch.float32):
+        head_dim = config.n_embd // config.n_head
+        shape = (batch_size, getattr(config, 'n_kv_head', 0) or config.n_head, config.block_size, head_dim)
+        self.k = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.v = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.seq_len = 0
+
+    def update(self, layer_idx, k, v):
+        """Write new keys/values after the cached ones, return the filled part of the buffers"""
+        end = self.seq_len + k.size(2)
+        self.k[layer_idx][:, :, self.seq_len:end] = k
+        self.v[layer_idx][:, :, self.seq_len:end] = v
+        return self.k[layer_idx][:, :, :end], self.v[layer_idx][:, :, :end]
+
+    def reset(self):
+        self.seq_len = 0
+
 class LayerNorm(nn.Module):
     def __init__(self, ndim, bias):
         super().__init__()
@@ -72,37 +102,64 @@ class LayerNorm(nn.Module):
         return F.layer_norm(x, self.weight.shape, self.weight, self.bias, 1e-5)
 
 class CausalSelfAttention(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         assert config.n_embd % config.n_head == 0
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=True)
+        # Grouped-query attention: n_head query heads share n_kv_head key/value heads (1 = multi-query)
+        self.n_kv_head = getattr(config, 'n_kv_head', 0) or config.n_head
+        assert config.n_head % self.n_kv_head == 0
+        self.kv_dim = config.n_embd // config.n_head * self.n_kv_head
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * self.kv_dim, bias=True)
         self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=True)
         self.attn_dropout = nn.Dropout(config.dropout)
         self.resid_dropout = nn.Dropout(config.dropout)
         self.n_head = config.n_head
         self.n_embd = config.n_embd
+        self.layer_idx = layer_idx
         self.flash = hasattr(F, 'scaled_dot_product_attention')
         if not self.flash:
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                        .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        """attn_mask: optional (B, 1, T, T_k) bool mask, True = may attend; already includes causality"""
         B, T, C = x.size()
-        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        q, k, v = self.c_attn(x).split([self.n_embd, self.kv_dim, self.kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        v = v.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)
+
+        if kv_cache is not None:
+            k, v = kv_cache.update(self.layer_idx, k, v)
+        T_k = k.size(2)  # queries are the last T of T_k positions
 
         if self.flash:
-            y = F.scaled_dot_product_attention(q, k, v, attn_mask=None, 
+            # is_causal aligns the mask top-left, so it only fits when there is no cached prefix
+            is_causal = attn_mask is None and T > 1 and T == T_k
+            if attn_mask is None and T > 1 and T != T_k:
+                attn_mask = torch.ones(T, T_k, dtype=torch.bool, device=x.device).tril(diagonal=T_k - T)
+            gqa = {}
+            if self.n_kv_head != self.n_head:
+                if SDPA_GQA:
+                    gqa = {'enable_gqa': True}
+                else:  # older torch: every query head gets its own copy of the shared K/V head
+                    k = k.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+                    v = v.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, 
                                               dropout_p=self.attn_dropout.p if self.training else 0.0, 
-                                              is_causal=True)
+                                              is_causal=is_causal, **gqa)
         else:
+            # The query heads sharing a K/V head are folded into its query rows: (B, n_kv_head, group * T, hs)
+            q = q.reshape(B, self.n_kv_head, -1, k.size(-1))
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:, :, :T, :T] == 0, float('-inf'))
+            att = att.view(B, self.n_kv_head, -1, T, T_k)
+            if attn_mask is not None:
+                att = att.masked_fill(~attn_mask.unsqueeze(2), float('-inf'))
+            else:
+                att = att.masked_fill(self.bias[:, :, T_k - T:T_k, :T_k] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
-            y = att @ v
+            y = (att.view(B, self.n_kv_head, -1, T_k) @ v).view(B, self.n_head, T, -1)
 
         y = y.transpose(1, 2).contiguous().view(B, T, C)
         y = self.resid_dropout(self.c_proj(y))
@@ -120,15 +177,15 @@ class MLP(nn.Module):
         return self.dropout(self.c_proj(self.gelu(self.c_fc(x))))
 
 class Block(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln1 = LayerNorm(config.n_embd, bias=True)
-        self.attn = CausalSelfAttention(config)
+        self.attn = CausalSelfAttention(config, layer_idx)
         self.ln2 = LayerNorm(config.n_embd, bias=True)
         self.mlp = MLP(config)
     
-    def forward(self, x):
-        x = x + self.attn(self.ln1(x))
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        x = x + self.attn(self.ln1(x), kv_cache=kv_cache, attn_mask=attn_mask)
         x = x + self.mlp(self.ln2(x))
         return x
 
@@ -140,11 +197,14 @@ class TinyGPT(nn.Module):
             wte=nn.Embedding(config.vocab_size, config.n_embd),
             wpe=nn.Embedding(config.block_size, config.n_embd),
             drop=nn.Dropout(config.dropout),
-            h=nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h=nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f=LayerNorm(config.n_embd, bias=True),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
         self.transformer.wte.weight = self.lm_head.weight
+        if getattr(config, 'compact_vocab', False):
+            # Tokenizer id of every compact id, saved with the weights (see vocab.py)
+            self.register_buffer('vocab_map', torch.full((config.vocab_size,), -1, dtype=torch.long))
 
         self.apply(self._init_weights)
         for pn, p in self.named_parameters():
@@ -159,50 +219,206 @@ class TinyGPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, padding_mask=None, all_logits=False):
+        """
+        padding_mask: optional (b, start + t) bool mask over cached + new positions,
+        False marks left padding. Real tokens get positions counted from their own row start.
+        all_logits: without targets, return logits for every position instead of only the last
+        """
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size
-        pos = torch.arange(0, t, dtype=torch.long, device=device)
+        start = kv_cache.seq_len if kv_cache is not None else 0
+        assert start + t <= self.config.block_size
+        attn_mask = None
+        if padding_mask is None:
+            pos = torch.arange(start, start + t, dtype=torch.long, device=device)
+        else:
+            pos = (padding_mask.long().cumsum(-1) - 1).clamp(min=0)[:, start:]
+            q_pos = torch.arange(start, start + t, device=device).view(-1, 1)
+            k_pos = torch.arange(start + t, device=device).view(1, -1)
+            # Every query may see itself, so padded rows never softmax over an empty set
+            attn_mask = (k_pos <= q_pos) & (padding_mask[:, None, :] | (k_pos == q_pos))
+            attn_mask = attn_mask.unsqueeze(1)
 
         tok_emb = self.transformer.wte(idx)
         pos_emb = self.transformer.wpe(pos)
         x = self.transformer.drop(tok_emb + pos_emb)
         for block in self.transformer.h:
-            x = block(x)
+            x = block(x, kv_cache=kv_cache, attn_mask=attn_mask)
         x = self.transformer.ln_f(x)
+        if kv_cache is not None:
+            kv_cache.seq_len += t
 
         if targets is not None:
             logits = self.lm_head(x)
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
             return logits, loss
         else:
-            logits = self.lm_head(x[:, [-1], :])
+            logits = self.lm_head(x if all_logits else x[:, [-1], :])
             return logits, None
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def prefill(self, idx, kv_cache, padding_mask=None):
+        """Encode the whole context once, filling the cache from position 0"""
+        kv_cache.reset()
+        logits, _ = self(idx, kv_cache=kv_cache, padding_mask=padding_mask)
+        return logits
+
+    @torch.no_grad()
+    def decode_step(self, idx_next, kv_cache, padding_mask=None):
+        """Encode one new token per row, attending to the cached keys/values"""
+        logits, _ = self(idx_next, kv_cache=kv_cache, padding_mask=padding_mask)
+        return logits
+
+    def _cache_dtype(self, device):
+        """KV cache dtype: the autocast dtype when generating under autocast (what attention consumes), else the weights'"""
+        if torch.is_autocast_enabled(device.type):
+            return torch.get_autocast_dtype(device.type)
+        return self.transformer.wpe.weight.dtype
+
+    def _check_window_shift(self, window_shift):
+        if window_shift is not None and not 0 < window_shift < self.config.block_size:
+            raise ValueError(f"window_shift must be in (0, {self.config.block_size}), got {window_shift}")
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_cache=True, window_shift=None,
+                 sampler=None, stop=None):
+        """
+        window_shift: long-form mode for generations past block_size. Once the cache is full,
+        drop the oldest window_shift tokens and re-encode the rest once (positions restart at 0),
+        then keep decoding from the cache. None re-encodes the cropped window on every step.
+        sampler: callable (logits, idx) -> next tokens, defaults to Sampler(temperature, top_k)
+        stop: optional StopSequences; generation ends early once every row has produced one
+        """
+        self._check_window_shift(window_shift)
+        sampler = sampler or Sampler(temperature, top_k)
+        prompt_len = idx.size(1)
+        kv_cache = None
+        if use_cache:
+            kv_cache = KVCache(self.config, idx.size(0), idx.device, self._cache_dtype(idx.device))
         for _ in range(max_new_tokens):
             idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            logits, _ = self(idx_cond)
-            logits = logits[:, -1, :] / temperature
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            probs = F.softmax(logits, dim=-1)
-            idx_next = torch.multinomial(probs, num_samples=1)
+            if kv_cache is None:
+                logits, _ = self(idx_cond)
+            elif 0 < kv_cache.seq_len < self.config.block_size:
+                logits = self.decode_step(idx[:, -1:], kv_cache)
+            elif kv_cache.seq_len > 0 and window_shift is not None:
+                logits = self.prefill(idx[:, -(self.config.block_size - window_shift):], kv_cache)
+            else:
+                # First step, or the window is full and positions shift: re-encode the cropped context
+                logits = self.prefill(idx_cond, kv_cache)
+            idx_next = sampler(logits[:, -1, :], idx)
             idx = torch.cat((idx, idx_next), dim=1)
+            if stop is not None and stop.check(idx[:, prompt_len:]).all():
+                break
         return idx
 
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=None, stop_token=None, pad_token=0,
+                       window_shift=None, sampler=None, stop=None):
+        """
+        Generate for a list of token lists of different lengths in one batch
+        Prompts are left-padded and masked; each row stops on its own at stop_token or at one of its
+        stop sequences (the token completing a stop string is kept, cut the text with stop.truncate)
+        window_shift, sampler and stop work as in generate()
+        Returns one list of new tokens per prompt (stop_token excluded)
+        """
+        self._check_window_shift(window_shift)
+        sampler = sampler or Sampler(temperature, top_k)
+        device = self.transformer.wpe.weight.device
+        block_size = self.config.block_size
+        B, max_len = len(prompts), max(len(p) for p in prompts)
+        idx = torch.full((B, max_len), pad_token, dtype=torch.long, device=device)
+        mask = torch.zeros((B, max_len), dtype=torch.bool, device=device)
+        for i, p in enumerate(prompts):
+            idx[i, max_len - len(p):] = torch.tensor(p, dtype=torch.long, device=device)
+            mask[i, max_len - len(p):] = True
+
+        kv_cache = KVCache(self.config, B, device, self._cache_dtype(device))
+        finished = torch.zeros(B, dtype=torch.bool, device=device)
+        for _ in range(max_new_tokens):
+            if 0 < kv_cache.seq_len < block_size:
+                logits = self.decode_step(idx[:, -1:], kv_cache, mask[:, -(kv_cache.seq_len + 1):])
+            elif kv_cache.seq_len > 0 and window_shift is not None:
+                keep = block_size - window_shift
+                logits = self.prefill(idx[:, -keep:], kv_cache, mask[:, -keep:])
+            else:
+                logits = self.prefill(idx[:, -block_size:], kv_cache, mask[:, -block_size:])
+            idx_next = sampler(logits[:, -1, :], idx, mask)
+            # Finished rows keep running as masked padding until the whole batch is done
+            idx_next = idx_next.masked_fill(finished[:, None], pad_token)
+            idx = torch.cat((idx, idx_next), dim=1)
+            mask = torch.cat((mask, ~finished[:, None]), dim=1)
+            if stop_token is not None:
+                finished |= idx_next[:, 0] == stop_token
+            if stop is not None:
+                new_tokens = [idx[i, max_len:][mask[i, max_len:]] for i in range(B)]
+                finished |= stop.check(new_tokens).to(device)
+            if finished.all():
+                break
+
+        outputs = []
+        for i in range(B):
+            new_tokens = idx[i, max_len:][mask[i, max_len:]].tolist()
+            if stop_token is not None and stop_token in new_tokens:
+                new_tokens = new_tokens[:new_tokens.index(stop_token)]
+            outputs.append(new_tokens)
+        return outputs
+
 
 # ============================================================================
 # PART 3: RUN ON LAPTOP (CPU Only - No GPU Required!)
 # ============================================================================
 
-def load_model_on_laptop(model_path="slm_trained_model.pt"):
+def quantize_for_cpu(model):
+    """
+    Dynamic int8 quantization of every nn.Linear: attention (c_attn, c_proj), MLP and the tied lm_head
+    Weights are stored as int8, activations are quantized on the fly - CPU inference only
+    The token embedding keeps its fp32 copy of the tied weight
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+COMPILE_CACHE_DIR = 'compile_cache'
+
+def compile_decode_step(model, cache_dir=COMPILE_CACHE_DIR):
+    """
+    torch.compile the single-token decode step in place, with inductor's on-disk graph cache in cache_dir
+    so the second run of a script skips most of the compile; dynamic=True keeps one graph for all lengths
+    """
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    model.decode_step = torch.compile(model.decode_step, dynamic=True)
+    return model
+
+
+def cpu_bf16_supported():
+    """True when the CPU has native bf16 matmuls (AVX512-BF16 or AMX), where bf16 autocast beats fp32"""
+    if hasattr(torch.cpu, '_is_avx512_bf16_supported'):
+        return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def cpu_autocast(enabled=True):
+    """bf16 autocast context for CPU inference (weights stay fp32), nullcontext when disabled or unsupported"""
+    if enabled and cpu_bf16_supported():
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def load_model_on_laptop(model_path="slm_trained_model.pt", quantize=None, compile=False, bf16=False):
     """
     Load a trained model on your laptop (CPU only)
+    quantize: None for fp32, "int8" for dynamic int8 Linear layers
+    compile: torch.compile the decode step (the first generation pays the compile time)
+    bf16: generate under bf16 autocast (stored as model.config.cpu_bf16), needs AVX512-BF16/AMX
     """
+    if quantize not in (None, "int8"):
+        raise ValueError(f"quantize must be None or 'int8', got {quantize!r}")
+    if bf16 and quantize is not None:
+        raise ValueError("bf16 autocast and int8 quantization are alternatives, pick one")
+    
     print("=" * 70)
     print("💻 LOADING MODEL ON LAPTOP (CPU)")
     print("=" * 70)
@@ -212,7 +428,7 @@ def load_model_on_laptop(model_path="slm_trained_model.pt"):
     
     # Load checkpoint
     print(f"📂 Loading model from: {model_path}")
-    checkpoint = torch.load(model_path, map_location=device)
+    checkpoint = torch.load(model_path, map_location=device, weights_only=False)  # config is a pickled dataclass
     
     # Reconstruct model
     config = checkpoint['config']
@@ -220,23 +436,33 @@ def load_model_on_laptop(model_path="slm_trained_model.pt"):
     model.load_state_dict(checkpoint['model_state_dict'])
     model.to(device)
     model.eval()  # Set to inference mode
+    if quantize == "int8":
+        model = quantize_for_cpu(model)
+    if compile:
+        compile_decode_step(model)
+    if bf16 and not cpu_bf16_supported():
+        print("⚠️  This CPU has no native bf16 (AVX512-BF16/AMX), staying in fp32")
+        bf16 = False
+    model.config.cpu_bf16 = bf16  # read by generate_on_laptop and LaptopSLM
     
     print(f"✅ Model loaded successfully!")
     print(f"🔧 Parameters: {checkpoint['param_count']:,}")
     print(f"💾 Device: {device}")
+    print(f"🔢 Precision: {'int8 (dynamic)' if quantize == 'int8' else 'bf16 autocast' if bf16 else 'fp32'}")
+    print(f"⚙️  Decode step: {'torch.compile' if compile else 'eager'}")
     print(f"🎯 Ready for inference on CPU!")
     
     return model, device
 
 
-def generate_on_laptop(model, device, prompt, max_tokens=50, temperature=0.8):
+def generate_on_laptop(model, device, prompt, max_tokens=50, temperature=0.8, use_cache=True):
     """
     Generate text on laptop CPU
     """
     import tiktoken
     import time
     
-    enc = tiktoken.get_encoding("gpt2")
+    enc = CompactVocab.from_model(model, tiktoken.get_encoding("gpt2"))
     
     # Tokenize prompt
     tokens = enc.encode_ordinary(prompt)
@@ -245,9 +471,9 @@ def generate_on_laptop(model, device, prompt, max_tokens=50, temperature=0.8):
     # Measure inference time
     start_time = time.time()
     
-    with torch.no_grad():
+    with torch.no_grad(), cpu_autocast(getattr(model.config, 'cpu_bf16', False)):
         generated = model.generate(context, max_new_tokens=max_tokens, 
-                                  temperature=temperature, top_k=40)
+                                  temperature=temperature, top_k=40, use_cache=use_cache)
     
     inference_time = time.time() - start_time
     
@@ -261,6 +487,30 @@ def generate_on_laptop(model, device, prompt, max_tokens=50, temperature=0.8):
     return output_text
 
 
+def generate_batch_on_laptop(model, device, prompts, max_tokens=50, temperature=0.8):
+    """
+    Generate for several prompts at once on laptop CPU (left-padded batch)
+    """
+    import tiktoken
+    import time
+    
+    enc = CompactVocab.from_model(model, tiktoken.get_encoding("gpt2"))
+    prompt_tokens = [enc.encode_ordinary(prompt) for prompt in prompts]
+    
+    start_time = time.time()
+    with cpu_autocast(getattr(model.config, 'cpu_bf16', False)):
+        new_tokens = model.generate_batch(prompt_tokens, max_new_tokens=max_tokens, temperature=temperature,
+                                          top_k=40, stop_token=enc.eot_token)
+    inference_time = time.time() - start_time
+    
+    total_tokens = sum(len(t) for t in new_tokens)
+    print(f"\n⏱️  Inference time: {inference_time:.2f} seconds (on CPU, batch of {len(prompts)})")
+    print(f"🔤 Tokens generated: {total_tokens}")
+    print(f"⚡ Aggregate speed: {total_tokens/inference_time:.1f} tokens/second")
+    
+    return [enc.decode(p + t) for p, t in zip(prompt_tokens, new_tokens)]
+
+
 def laptop_demo():
     """
     Complete demo for running on laptop
@@ -284,15 +534,72 @@ def laptop_demo():
     print("📝 GENERATION TESTS")
     print("=" * 70)
     
-    for prompt in test_prompts:
+    outputs = generate_batch_on_laptop(model, device, test_prompts, max_tokens=40, temperature=0.8)
+    
+    for prompt, output in zip(test_prompts, outputs):
         print(f"\n{'='*70}")
         print(f"🔹 Prompt: '{prompt}'")
         print(f"{'='*70}")
-        
-        output = generate_on_laptop(model, device, prompt, max_tokens=40, temperature=0.8)
         print(f"\n📖 Generated Story:\n{output}\n")
 
 
+def compare_quantization(model_path="slm_trained_model.pt", sample_text=None, prompts=None, max_tokens=40):
+    """
+    Report validation loss and generation latency of fp32 vs int8 side by side
+    sample_text defaults to the text train_on_cloud() used, so the val split matches training
+    """
+    import time
+    import tiktoken
+    from contextlib import nullcontext
+    from train import create_tiny_dataset_from_text, evaluate_full
+    from config import get_sample_text
+    
+    prompts = prompts or ["Once upon a time", "The little cat", "In a big forest", "A brave dog"]
+    enc = tiktoken.get_encoding("gpt2")
+    
+    results = {}
+    for quantize in (None, "int8"):
+        model, device = load_model_on_laptop(model_path, quantize=quantize)
+        config = model.config
+        if sample_text is None:
+            sample_text = get_sample_text(size_multiplier=25)
+        _, val_data, _ = create_tiny_dataset_from_text(sample_text, config)  # compact ids if compact_vocab
+        
+        val_loss = evaluate_full(model, val_data, config, device, nullcontext())['loss']  # exact, token-weighted
+        
+        tokenizer = CompactVocab.from_model(model, enc)
+        contexts = [torch.tensor(tokenizer.encode_ordinary(p), dtype=torch.long).unsqueeze(0) for p in prompts]
+        torch.manual_seed(0)
+        model.generate(contexts[0], max_new_tokens=4)  # warm-up
+        start_time = time.time()
+        for context in contexts:
+            model.generate(context, max_new_tokens=max_tokens, temperature=0.8, top_k=40)
+        elapsed = time.time() - start_time
+        
+        results[quantize or "fp32"] = {
+            'val_loss': val_loss,
+            'latency': elapsed / len(prompts),
+            'tokens_per_sec': len(prompts) * max_tokens / elapsed,
+        }
+    
+    fp32, int8 = results["fp32"], results["int8"]
+    print("\n" + "=" * 70)
+    print("⚖️  FP32 vs INT8 (dynamic) ON CPU")
+    print("=" * 70)
+    print(f"{'Metric':<26} {'fp32':>12} {'int8':>12} {'change':>12}")
+    print("-" * 70)
+    print(f"{'Val loss':<26} {fp32['val_loss']:>12.4f} {int8['val_loss']:>12.4f} "
+          f"{int8['val_loss'] - fp32['val_loss']:>+12.4f}")
+    print(f"{'Val perplexity':<26} {math.exp(fp32['val_loss']):>12.2f} {math.exp(int8['val_loss']):>12.2f} "
+          f"{math.exp(int8['val_loss']) - math.exp(fp32['val_loss']):>+12.2f}")
+    print(f"{'Latency / prompt (s)':<26} {fp32['latency']:>12.3f} {int8['latency']:>12.3f} "
+          f"{fp32['latency'] / int8['latency']:>11.2f}x")
+    print(f"{'Tokens/second':<26} {fp32['tokens_per_sec']:>12.1f} {int8['tokens_per_sec']:>12.1f}")
+    print("=" * 70)
+    
+    return results
+
+
 # ============================================================================
 # PART 4: INTERACTIVE LAPTOP INTERFACE
 # ============================================================================
@@ -302,34 +609,69 @@ class LaptopSLM:
     Easy-to-use interface for laptop inference
     """
     
-    def __init__(self, model_path="slm_trained_model.pt"):
-        """Load model once, use many times"""
-        self.model, self.device = load_model_on_laptop(model_path)
+    def __init__(self, model_path="slm_trained_model.pt", quantize=None, compile=False, bf16=False):
+        """
+        Load model once, use many times
+        quantize="int8" for the int8 CPU path, compile=True for torch.compile, bf16=True for bf16 autocast
+        """
+        self.model, self.device = load_model_on_laptop(model_path, quantize=quantize, compile=compile, bf16=bf16)
+        self.ctx = cpu_autocast(self.model.config.cpu_bf16)
         
         import tiktoken
-        self.tokenizer = tiktoken.get_encoding("gpt2")
-    
-    def generate(self, prompt, max_tokens=50, temperature=0.8, show_stats=True):
-        """Simple generation method"""
+        self.tokenizer = CompactVocab.from_model(self.model, tiktoken.get_encoding("gpt2"))
+    
+    def generate(self, prompt, max_tokens=50, temperature=0.8, show_stats=True, use_cache=True,
+                 top_p=None, repetition_penalty=1.0, stop_sequences=None, seed=None):
+        """
+        Simple generation method (KV-cached decoding unless use_cache=False)
+        top_p, repetition_penalty and seed configure the Sampler (temperature=0 means greedy);
+        stop_sequences (e.g. ["\\n\\n"]) end the story early and are cut from the text
+        """
         import time
         
         tokens = self.tokenizer.encode_ordinary(prompt)
         context = torch.tensor(tokens, dtype=torch.long, device=self.device).unsqueeze(0)
+        sampler = Sampler(temperature, top_k=40, top_p=top_p, repetition_penalty=repetition_penalty,
+                          seeds=None if seed is None else [seed])
+        stop = StopSequences(self.tokenizer, stop_sequences) if stop_sequences else None
         
         start_time = time.time()
         
-        with torch.no_grad():
-            generated = self.model.generate(context, max_new_tokens=max_tokens, 
-                                          temperature=temperature, top_k=40)
+        with torch.no_grad(), self.ctx:
+            generated = self.model.generate(context, max_new_tokens=max_tokens, use_cache=use_cache,
+                                          sampler=sampler, stop=stop)
         
         inference_time = time.time() - start_time
-        output_text = self.tokenizer.decode(generated.squeeze().tolist())
+        new_tokens = generated.size(1) - len(tokens)
+        if stop is None:
+            output_text = self.tokenizer.decode(generated.squeeze().tolist())
+        else:
+            new_text = self.tokenizer.decode(generated[0, len(tokens):].tolist())
+            output_text = self.tokenizer.decode(tokens) + stop.truncate(new_text)
         
         if show_stats:
-            print(f"⏱️  Time: {inference_time:.2f}s | Speed: {max_tokens/inference_time:.1f} tok/s")
+            print(f"⏱️  Time: {inference_time:.2f}s | Speed: {new_tokens/inference_time:.1f} tok/s")
         
         return output_text
     
+    def generate_batch(self, prompts, max_tokens=50, temperature=0.8, show_stats=True):
+        """Generate for several prompts in one left-padded batch"""
+        import time
+        
+        prompt_tokens = [self.tokenizer.encode_ordinary(prompt) for prompt in prompts]
+        
+        start_time = time.time()
+        with self.ctx:
+            new_tokens = self.model.generate_batch(prompt_tokens, max_new_tokens=max_tokens, temperature=temperature,
+                                                   top_k=40, stop_token=self.tokenizer.eot_token)
+        inference_time = time.time() - start_time
+        
+        if show_stats:
+            total_tokens = sum(len(t) for t in new_tokens)
+            print(f"⏱️  Time: {inference_time:.2f}s | Aggregate speed: {total_tokens/inference_time:.1f} tok/s")
+        
+        return [self.tokenizer.decode(p + t) for p, t in zip(prompt_tokens, new_tokens)]
+    
     def interactive_mode(self):
         """Interactive story generation"""
         print("\n" + "=" * 70)
@@ -375,6 +717,16 @@ if __name__ == "__main__":
     # slm = LaptopSLM("slm_trained_model.pt")
     # slm.interactive_mode()
     
+    # Int8 CPU inference (check the trade-off first with compare_quantization())
+    # compare_quantization("slm_trained_model.pt")
+    # slm = LaptopSLM("slm_trained_model.pt", quantize="int8")
+    
+    # Compiled decode step (slow first generation, cached on disk for the next run)
+    # slm = LaptopSLM("slm_trained_model.pt", compile=True)
+    
+    # bf16 autocast on CPUs with AVX512-BF16/AMX (see benchmark_bf16.py for the accuracy/speed trade-off)
+    # slm = LaptopSLM("slm_trained_model.pt", bf16=True)
+    
     
     # ========================================================================
     # OPTION 3: Quick one-off generation
@@ -391,14 +743,15 @@ if __name__ == "__main__":
 📋 WORKFLOW SUMMARY:
 
 1️⃣  ON CLOUD (Google Colab with GPU):
-   - Upload train.py, config.py to Colab
+   - Upload train.py, config.py, sampling.py, vocab.py to Colab
    - Run: train_on_cloud()
    - Download: slm_trained_model.pt (~10-50 MB)
 
 2️⃣  ON LAPTOP (CPU only):
-   - Put slm_trained_model.pt in same folder
+   - Put slm_trained_model.pt, sampling.py and vocab.py in same folder
    - Run: laptop_demo()
    - Or: slm = LaptopSLM(); slm.interactive_mode()
+   - Faster: slm = LaptopSLM(quantize="int8") (see compare_quantization())
 
 📊 EXPECTED PERFORMANCE ON LAPTOP CPU:
    - Small model (10M params): ~20-40 tokens/second
@@ -15,6 +15,7 @@ class ExperimentConfig:
     # MODEL ARCHITECTURE
     n_layer: int = 2                 # Number of transformer layers (2-12)
     n_head: int = 2                  # Number of attention heads (2-8)
+    n_kv_head: int = 0               # Key/value heads shared by the query heads (1 = multi-query, 0 = n_head)
     n_embd: int = 64                 # Embedding dimension (64-512)
     block_size: int = 32             # Context window (16-128)
     dropout: float = 0.1             # Dropout rate (0.0-0.3)
@@ -26,10 +27,25 @@ class ExperimentConfig:
     warmup_steps: int = 50           # LR warmup steps
     gradient_accumulation_steps: int = 4  # Gradient accumulation
     eval_interval: int = 100         # Evaluate every N steps
+    prefetch_batches: int = 2        # Batches prepared ahead by a background thread (0 = off)
+    async_eval: bool = False         # Score weight snapshots in a worker process while training continues
+    eval_threads: int = 1            # torch threads for the async eval worker
+    eval_mode: str = 'sampled'       # 'sampled' (random batches) or 'full' (every val token once)
+    eval_batch_size: int = 64        # Windows per forward pass in 'full' eval, independent of batch_size
+    keep_last_checkpoints: int = 0   # Also keep the N most recent eval checkpoints next to the best one
+    checkpoint_interval: int = 0     # Full training state for resume=True every N iterations (0 = off)
+    compile: bool = False            # torch.compile the training step (see benchmark_compile.py)
+    cpu_bf16: bool = False           # bf16 autocast on CPUs with native bf16 (AVX512-BF16/AMX), fp32 weights
+    loss_chunk_tokens: int = 256     # lm_head + cross-entropy in chunks of N tokens, never the full logits (0 = off)
+    activation_checkpointing: int = 0  # recompute every k-th Block in backward instead of storing it (1 = all, 0 = off)
+    auto_batch_tokens: int = 0       # Tokens per optimizer step; train_slm then picks batch_size/accumulation (0 = off)
+    memory_budget_mb: int = 0        # Peak memory per process allowed to auto batch sizing (0 = 80% of RAM/GPU)
+    optimizer: str = 'adamw'         # 'adamw', or low-memory 'adamw8bit' / 'factored' (see optimizers.py)
     
     # MISC
     vocab_size: int = 50257          # GPT-2 tokenizer vocab size
     seed: int = 42                   # Random seed for reproducibility
+    compact_vocab: bool = False      # Train on the token ids present in the data only (see vocab.py)
 
 
 # ============================================================================
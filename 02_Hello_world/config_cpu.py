@@ -17,6 +17,7 @@ class ExperimentConfig:
     # MODEL ARCHITECTURE
     n_layer: int = 2
     n_head: int = 2
+    n_kv_head: int = 0  # key/value heads shared by the query heads (1 = multi-query, 0 = n_head), see benchmark_gqa.py
     n_embd: int = 64
     block_size: int = 32
     dropout: float = 0.1
@@ -28,10 +29,25 @@ class ExperimentConfig:
     warmup_steps: int = 50
     gradient_accumulation_steps: int = 4
     eval_interval: int = 100
+    prefetch_batches: int = 2  # Batches prepared ahead by a background thread (0 = off)
+    async_eval: bool = False  # Score weight snapshots in a worker process while training continues
+    eval_threads: int = 1  # torch threads for the async eval worker
+    eval_mode: str = 'sampled'  # 'sampled' (random batches) or 'full' (every val token once)
+    eval_batch_size: int = 64  # Windows per forward pass in 'full' eval, independent of batch_size
+    keep_last_checkpoints: int = 0  # Also keep the N most recent eval checkpoints next to the best one
+    checkpoint_interval: int = 0  # Full training state for resume=True every N iterations (0 = off)
+    compile: bool = False  # torch.compile the training step (see benchmark_compile.py)
+    cpu_bf16: bool = False  # bf16 autocast on CPUs with native bf16 (AVX512-BF16/AMX), see benchmark_bf16.py
+    loss_chunk_tokens: int = 256  # lm_head + cross-entropy in chunks of N tokens, never the full logits (0 = off)
+    activation_checkpointing: int = 0  # recompute every k-th Block in backward (1 = all, 0 = off), see benchmark_checkpointing.py
+    auto_batch_tokens: int = 0  # tokens per optimizer step; train_slm then picks batch_size/accumulation (0 = off)
+    memory_budget_mb: int = 0  # peak memory per process allowed to auto batch sizing (0 = 80% of RAM/GPU)
+    optimizer: str = 'adamw'  # 'adamw', or low-memory 'adamw8bit' / 'factored' (see optimizers.py)
     
     # MISC
     vocab_size: int = 50257
     seed: int = 42
+    compact_vocab: bool = False  # Train on the token ids present in the data only (see vocab.py)
 
 
 # ============================================================================
@@ -108,6 +124,18 @@ CONFIG_LARGE_CPU = ExperimentConfig(
     eval_interval=200
 )
 
+# cpu_bf16=True on the configs above (benchmark_bf16.py: <= 200 iterations, 1 thread, AMX CPU)
+# Delta = bf16 minus fp32 exact val loss; speedup = bf16 over fp32 tokens/s (run-to-run noise about +-0.15)
+#
+#   Config        Val fp32   Delta     Train speedup   Gen speedup
+#   ULTRA_TINY    7.1157     -0.0006   1.03x           0.73x
+#   TINY_CPU      6.9119     +0.0017   0.82x           0.59x
+#   SMALL_CPU     6.4667     -0.0003   0.95x           0.93x
+#   MEDIUM_CPU    9.1243     -0.0004   1.14x           1.08x
+#   LARGE_CPU     9.0423     +0.0003   1.11x           0.84x
+#
+# Accuracy is unchanged; at n_embd <= 128 bf16 GEMMs cost about what they save, so cpu_bf16 stays off by default
+
 
 # ============================================================================
 # GPU-OPTIMIZED CONFIGURATIONS (For Cloud Training)
@@ -143,7 +171,7 @@ CONFIG_MEDIUM_GPU = ExperimentConfig(
 CONFIG_LARGE_GPU = ExperimentConfig(
     dataset_size=20000,
     n_layer=6,
-    n_head=6,
+    n_head=8,                    # n_embd must split evenly across heads
     n_embd=256,
     block_size=64,
     max_iters=5000,
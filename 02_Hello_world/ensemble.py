@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+ensemble.py - Vmapped Ensemble Trainer
+Trains several same-shape TinyGPT configs (differing in seed, learning rate or data) in one forward/backward:
+member weights are stacked along a leading dim and the transformer blocks run under torch.func.vmap
+Every member still gets its own checkpoint, loadable exactly like a train_slm checkpoint
+Pays off when per-step kernels are tiny (compact_vocab, small n_embd); with the full 50257-id vocabulary
+the step is dominated by each member's lm_head GEMM, which stacking cannot make cheaper
+"""
+
+import copy
+import time
+from contextlib import nullcontext
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import stack_module_state, functional_call, vmap
+from dataclasses import replace
+from tqdm.auto import tqdm
+
+from train import (TinyGPT, ChunkedLMHeadLoss, BatchLoader, CheckpointWriter, estimate_loss, cpu_state_dict, plot_training_curves,
+                   create_tiny_dataset_from_text)
+from config_cpu import CONFIG_TINY_CPU, get_sample_text
+
+# Fields every member must agree on: they fix the stacked weight shapes and the shared step schedule
+ENSEMBLE_SHARED_FIELDS = ('n_layer', 'n_head', 'n_kv_head', 'n_embd', 'block_size', 'vocab_size', 'dropout',
+                          'compact_vocab', 'batch_size', 'gradient_accumulation_steps', 'max_iters', 'eval_interval')
+
+# ============================================================================
+# STACKED MODEL AND OPTIMIZER
+# ============================================================================
+
+def check_ensemble_configs(configs):
+    """Raise ValueError when the configs cannot be stacked into one ensemble"""
+    if not configs:
+        raise ValueError("An ensemble needs at least one config")
+    for field in ENSEMBLE_SHARED_FIELDS:
+        values = {getattr(config, field) for config in configs}
+        if len(values) > 1:
+            raise ValueError(f"Ensemble members must share {field}, got {sorted(values)}")
+    if any(config.optimizer != 'adamw' for config in configs):
+        raise ValueError("Ensembles train with StackedAdamW, the low-memory optimizers are not stacked")
+
+
+class _Trunk(nn.Module):
+    """TinyGPT.forward up to ln_f (no KV cache, no padding), the part of the model that runs under vmap"""
+    def __init__(self, model):
+        super().__init__()
+        self.transformer = model.transformer
+
+    def forward(self, idx):
+        pos = torch.arange(idx.size(1), dtype=torch.long, device=idx.device)
+        x = self.transformer.drop(self.transformer.wte(idx) + self.transformer.wpe(pos))
+        for block in self.transformer.h:
+            x = block(x)
+        return self.transformer.ln_f(x)
+
+
+class ModelEnsemble:
+    """
+    M TinyGPTs as stacked (M, ...) leaf tensors; ensemble(X, Y) with (M, B, T) batches -> (M,) losses
+    Members are initialized exactly like TinyGPT(config) after torch.manual_seed(config.seed)
+    members[i] is a regular TinyGPT, refreshed from the stacked weights by sync_members() (eval, checkpoints)
+    """
+    def __init__(self, configs, device='cpu'):
+        check_ensemble_configs(configs)
+        self.configs = list(configs)
+        self.members = []
+        for config in self.configs:
+            torch.manual_seed(config.seed)
+            self.members.append(TinyGPT(config).to(device))
+        # Parameter names come from named_parameters, so the tied lm_head is transformer.wte.weight
+        self.params, self.buffers = stack_module_state(self.members)
+
+        # Weightless template for functional_call; randomness='different' gives every member its own dropout masks
+        self.trunk = _Trunk(copy.deepcopy(self.members[0]).to('meta'))
+        self.trunk_buffers = {name: b for name, b in self.buffers.items() if name.startswith('transformer.')}
+        self.forward_hidden = vmap(self._member_hidden, randomness='different')
+
+    def __len__(self):
+        return len(self.members)
+
+    def _member_hidden(self, params, buffers, x):
+        return functional_call(self.trunk, (params, buffers), (x,))
+
+    def __call__(self, X, Y):
+        hidden = self.forward_hidden(self.params, self.trunk_buffers, X)
+        # lm_head + cross-entropy per member: under vmap the (M, V, C) head weight gets a transposed gradient
+        # and the softmax runs over a strided dim, both far slower than M plain contiguous GEMMs
+        head_weights = self.params['transformer.wte.weight'].unbind(0)
+        return torch.stack([self._head_loss(h.flatten(0, 1), w, y.flatten(), config)
+                            for h, w, y, config in zip(hidden.unbind(0), head_weights, Y.unbind(0), self.configs)])
+
+    @staticmethod
+    def _head_loss(h, w, y, config):
+        """Same loss path as TinyGPT.forward: chunked once the batch exceeds config.loss_chunk_tokens"""
+        chunk_size = getattr(config, 'loss_chunk_tokens', 0)
+        if not chunk_size or h.size(0) <= chunk_size:
+            return F.cross_entropy(F.linear(h, w), y, ignore_index=-1)
+        return ChunkedLMHeadLoss.apply(h, w, y, chunk_size)
+
+    def parameters(self):
+        return list(self.params.values())
+
+    def train(self, mode=True):
+        self.trunk.train(mode)
+
+    @torch.no_grad()
+    def clip_grad_norm_(self, max_norm):
+        """clip_grad_norm_ applied to every member separately; returns the (M,) gradient norms"""
+        grads = [p.grad for p in self.parameters() if p.grad is not None]
+        norms = torch.stack([g.flatten(1).pow(2).sum(1) for g in grads]).sum(0).sqrt()
+        scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.mul_(scale.view(-1, *[1] * (g.dim() - 1)))
+        return norms
+
+    @torch.no_grad()
+    def sync_members(self):
+        """Copy the stacked weights into members[i] (named_parameters skips the tied lm_head like stacking did)"""
+        for i, member in enumerate(self.members):
+            for name, p in member.named_parameters():
+                p.copy_(self.params[name][i])
+            for name, b in member.named_buffers():
+                b.copy_(self.buffers[name][i])
+        return self.members
+
+
+class StackedAdamW:
+    """
+    AdamW over stacked (M, ...) parameters with one learning rate per member
+    Same update and hyperparameters as the torch.optim.AdamW in train_slm
+    """
+    def __init__(self, params, lrs, betas=(0.9, 0.95), weight_decay=0.1, eps=1e-9):
+        self.params = list(params)
+        self.lrs = torch.as_tensor(lrs, dtype=self.params[0].dtype, device=self.params[0].device)
+        self.betas = betas
+        self.weight_decay = weight_decay
+        self.eps = eps
+        self.step_count = 0
+        self.exp_avg = [torch.zeros_like(p) for p in self.params]
+        self.exp_avg_sq = [torch.zeros_like(p) for p in self.params]
+        # Stacked tensors are M times larger than a single model's, large enough that the allocator
+        # returns them to the OS when freed; scratch space and gradients are therefore kept between steps
+        self.scratch = [torch.zeros_like(p) for p in self.params]
+
+    @torch.no_grad()
+    def step(self):
+        self.step_count += 1
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.step_count
+        bias_correction2_sqrt = (1 - beta2 ** self.step_count) ** 0.5
+        for p, exp_avg, exp_avg_sq, update in zip(self.params, self.exp_avg, self.exp_avg_sq, self.scratch):
+            if p.grad is None:
+                continue
+            lr = self.lrs.view(-1, *[1] * (p.dim() - 1))
+            p.mul_(1 - lr * self.weight_decay)
+            exp_avg.lerp_(p.grad, 1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+            torch.sqrt(exp_avg_sq, out=update).div_(bias_correction2_sqrt).add_(self.eps)
+            update.reciprocal_().mul_(exp_avg).mul_(lr / bias_correction1)
+            p.sub_(update)
+
+    def zero_grad(self):
+        """Zero the gradients in place (see scratch above)"""
+        for p in self.params:
+            if p.grad is not None:
+                p.grad.zero_()
+
+# ============================================================================
+# ENSEMBLE TRAINING
+# ============================================================================
+
+def train_ensemble(configs, datasets, tokenizer, model_names=None, device='cpu'):
+    """
+    Train all configs at once; datasets: one (train_data, val_data) per config
+    Each member keeps its own batch RNG (config.seed), learning rate, eval history and best checkpoint
+    (model_names[i].pt, a plain TinyGPT state dict) and training curve (model_names[i].png)
+    Returns the trained member models (TinyGPT) and the ensemble's training stats
+    """
+    check_ensemble_configs(configs)
+    if len(datasets) != len(configs):
+        raise ValueError(f"Expected {len(configs)} (train_data, val_data) pairs, got {len(datasets)}")
+    model_names = model_names or [f"ensemble_member{i}" for i in range(len(configs))]
+    config = configs[0]  # shared schedule and shapes (see ENSEMBLE_SHARED_FIELDS)
+    if config.compact_vocab:
+        configs = [replace(c, vocab_size=tokenizer.n_vocab) for c in configs]
+        config = configs[0]
+
+    ensemble = ModelEnsemble(configs, device)
+    if config.compact_vocab:
+        ensemble.buffers['vocab_map'].copy_(tokenizer.vocab_map().expand(len(configs), -1))
+    optimizer = StackedAdamW(ensemble.parameters(), [c.learning_rate for c in configs])
+    ctx = nullcontext()  # fp32, as train_slm on CPU
+
+    print(f"\n🚀 Training an ensemble of {len(configs)} models for {config.max_iters} iterations...")
+    print(f"   Device: {device}")
+    print(f"   Parameters per member: {ensemble.members[0].param_count:,}")
+    for name, c in zip(model_names, configs):
+        print(f"   {name}: seed={c.seed}, learning_rate={c.learning_rate}, dataset_size={c.dataset_size}")
+
+    batch_loaders = [BatchLoader(train_data, config.block_size, config.batch_size, 'cpu',
+                                 rng=np.random.RandomState(c.seed)) for c, (train_data, _) in zip(configs, datasets)]
+    eval_loaders = [(BatchLoader(train_data, config.block_size, config.batch_size, device),
+                     BatchLoader(val_data, config.block_size, config.batch_size, device))
+                    for train_data, val_data in datasets]
+    X = torch.empty(len(configs), config.batch_size, config.block_size, dtype=torch.long)
+    Y = torch.empty_like(X)
+
+    histories = [{'eval_steps': [], 'train': [], 'val': [], 'best_val': float('inf')} for _ in configs]
+    writer = CheckpointWriter(keep_last=config.keep_last_checkpoints)
+
+    def evaluate(eval_iter):
+        for member, c, (train_loader, val_loader), history, name in zip(
+                ensemble.sync_members(), configs, eval_loaders, histories, model_names):
+            losses = estimate_loss(member, train_loader, val_loader, c, device, ctx)
+            history['eval_steps'].append(eval_iter)
+            history['train'].append(losses['train'])
+            history['val'].append(losses['val'])
+            improved = losses['val'] < history['best_val']
+            snapshot = cpu_state_dict(member) if improved or writer.keep_last > 0 else None
+            writer.save_last(snapshot, f"{name}_step{eval_iter}.pt")
+            if improved:
+                history['best_val'] = losses['val']
+                writer.save(snapshot, f"{name}.pt")
+        print(f"\nStep {eval_iter}: val loss " + ", ".join(f"{h['val'][-1]:.4f}" for h in histories))
+
+    loop_start_time = time.perf_counter()
+    for iter_num in tqdm(range(config.max_iters)):
+        if iter_num % config.eval_interval == 0:
+            evaluate(iter_num)
+
+        for i, loader in enumerate(batch_loaders):
+            loader.sample_into(X[i], Y[i])
+        losses = ensemble(X.to(device), Y.to(device))
+        # Members are independent, so the summed loss gives every member exactly its own gradient
+        (losses.sum() / config.gradient_accumulation_steps).backward()
+
+        if (iter_num + 1) % config.gradient_accumulation_steps == 0:
+            ensemble.clip_grad_norm_(1.0)
+            optimizer.step()
+            optimizer.zero_grad()
+
+    loop_time = time.perf_counter() - loop_start_time
+    tokens_per_sec = config.max_iters * len(configs) * config.batch_size * config.block_size / loop_time
+    stats = {'members': len(configs), 'loop_time': loop_time, 'tokens_per_sec': tokens_per_sec}
+
+    # Final evaluation and artifacts per member
+    members = ensemble.sync_members()
+    print(f"\n✅ Ensemble training complete! ({tokens_per_sec:,.0f} tokens/s over {len(configs)} members)")
+    print(f"\n{'Member':<20} {'Seed':<6} {'LR':<10} {'Final train':<12} {'Final val':<12} {'Best val':<10}")
+    print("-"*70)
+    for member, c, (train_loader, val_loader), history, name in zip(
+            members, configs, eval_loaders, histories, model_names):
+        final = estimate_loss(member, train_loader, val_loader, c, device, ctx)
+        print(f"{name:<20} {c.seed:<6} {c.learning_rate:<10g} {final['train']:<12.4f} {final['val']:<12.4f} "
+              f"{history['best_val']:<10.4f}")
+        writer.submit(plot_training_curves, history['eval_steps'], history['train'], history['val'],
+                      f'{name} (seed {c.seed}, lr {c.learning_rate:g})', f"{name}.png")
+    writer.close()
+    print(f"💾 Checkpoints: " + ", ".join(f"{name}.pt" for name in model_names))
+
+    return members, stats
+
+# ============================================================================
+# THROUGHPUT COMPARISON
+# ============================================================================
+
+def compare_ensemble_throughput(configs, datasets, iters=30, device='cpu'):
+    """
+    Training tokens/s for the vmapped ensemble vs. the same members trained one after another
+    Both sides run the same steps (forward, backward, clip, AdamW) on identically sampled batches
+    """
+    check_ensemble_configs(configs)
+    config = configs[0]
+    loaders = [BatchLoader(train_data, config.block_size, config.batch_size, 'cpu',
+                           rng=np.random.RandomState(c.seed)) for c, (train_data, _) in zip(configs, datasets)]
+    X = torch.empty(len(configs), config.batch_size, config.block_size, dtype=torch.long)
+    Y = torch.empty_like(X)
+
+    def sample():
+        for i, loader in enumerate(loaders):
+            loader.sample_into(X[i], Y[i])
+        return X.to(device), Y.to(device)
+
+    # One by one: a regular model and torch.optim.AdamW per member, as train_slm does
+    sequential_time = 0.0
+    for i, c in enumerate(configs):
+        torch.manual_seed(c.seed)
+        model = TinyGPT(c).to(device)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=c.learning_rate,
+                                      betas=(0.9, 0.95), weight_decay=0.1, eps=1e-9)
+        for step in range(iters + 1):  # step 0 is warm-up
+            xb, yb = sample()
+            start_time = time.perf_counter()
+            _, loss = model(xb[i], yb[i])
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            if step > 0:
+                sequential_time += time.perf_counter() - start_time
+
+    ensemble = ModelEnsemble(configs, device)
+    optimizer = StackedAdamW(ensemble.parameters(), [c.learning_rate for c in configs])
+    ensemble_time = 0.0
+    for step in range(iters + 1):
+        xb, yb = sample()
+        start_time = time.perf_counter()
+        ensemble(xb, yb).sum().backward()
+        ensemble.clip_grad_norm_(1.0)
+        optimizer.step()
+        optimizer.zero_grad()
+        if step > 0:
+            ensemble_time += time.perf_counter() - start_time
+
+    tokens = iters * len(configs) * config.batch_size * config.block_size
+    print("\n" + "="*70)
+    print(f"⚡ ENSEMBLE THROUGHPUT ({len(configs)} members, {iters} steps each, {torch.get_num_threads()} thread(s))")
+    print("="*70)
+    print(f"{'Mode':<20} {'Time (s)':<10} {'Tokens/s':<12} {'Speedup':<8}")
+    print("-"*70)
+    print(f"{'one by one':<20} {sequential_time:<10.2f} {tokens / sequential_time:<12,.0f} {'1.00x':<8}")
+    print(f"{'vmapped ensemble':<20} {ensemble_time:<10.2f} {tokens / ensemble_time:<12,.0f} "
+          f"{f'{sequential_time / ensemble_time:.2f}x':<8}")
+    return {'sequential_tokens_per_sec': tokens / sequential_time, 'ensemble_tokens_per_sec': tokens / ensemble_time}
+
+
+if __name__ == "__main__":
+    # Seed x learning-rate sweep of the TINY CPU config on the same 200-token text
+    # (one shared compact vocabulary keeps the per-member kernels small, see the module docstring)
+    base_config = replace(CONFIG_TINY_CPU, compact_vocab=True)
+    configs = [replace(base_config, seed=seed, learning_rate=lr)
+               for seed in (42, 43) for lr in (1e-3, 3e-3)]
+    sample_text = get_sample_text(size_multiplier=2)
+    datasets = []
+    for config in configs:
+        train_data, val_data, tokenizer = create_tiny_dataset_from_text(sample_text, config)
+        datasets.append((train_data, val_data))
+    configs = [replace(c, vocab_size=tokenizer.n_vocab) for c in configs]
+
+    compare_ensemble_throughput(configs, datasets)
+    members, stats = train_ensemble(configs, datasets, tokenizer,
+                                    model_names=[f"tiny_seed{c.seed}_lr{c.learning_rate:g}" for c in configs])
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+optimizers.py - Low-memory AdamW Variants in Pure PyTorch
+AdamW keeps two fp32 moments per parameter; with the 50257-row tied embedding that is 8 bytes x 50257 x n_embd
+of optimizer state even for the tiniest model. Both variants follow AdamW's update and run on CPU:
+    AdamW8bit      - both moments block-wise quantized to 8 bits (2 bytes per parameter instead of 8)
+    FactoredAdamW  - Adafactor-style second moment for matrices: one row and one column statistic
+Large parameters are updated in STEP_CHUNK pieces, so the fp32 temporaries stay small and in cache
+"""
+
+import torch
+
+# ============================================================================
+# BLOCK-WISE 8-BIT QUANTIZATION
+# ============================================================================
+
+QUANT_BLOCK = 256         # elements sharing one fp32 scale
+MIN_8BIT_NUMEL = 4096     # smaller tensors (LayerNorm, biases) keep fp32 moments, the scales would cost more
+STEP_CHUNK = 1 << 16      # elements per piece of an update (a multiple of QUANT_BLOCK)
+
+
+def _stochastic_round(levels, dither):
+    """
+    Round up with probability equal to the fractional part: unbiased, so a moment that decays by beta every step
+    still decays after re-encoding (nearest rounding would pin small codes in place)
+    dither: uniform [0, 1) noise with at least as many rows as levels (one tile per step, see AdamW8bit.step)
+    """
+    return levels.add_(dither[:levels.size(0)]).floor_()
+
+
+def _blocks(x):
+    """Flat x padded with zeros to whole QUANT_BLOCK rows: (n_blocks, QUANT_BLOCK)"""
+    pad = -x.numel() % QUANT_BLOCK
+    if pad:
+        x = torch.cat([x, x.new_zeros(pad)])
+    return x.view(-1, QUANT_BLOCK)
+
+
+def quantize_signed(blocks, dither):
+    """
+    First moment blocks -> (int8 codes, per-block absmax); companded through sqrt so that entries far below
+    their block's largest one still get distinct codes
+    """
+    magnitude = blocks.abs()
+    scale = magnitude.amax(dim=1)
+    levels = magnitude.mul_((127**2 / scale.clamp(min=1e-30))[:, None]).sqrt_()
+    codes = _stochastic_round(levels, dither).clamp_(max=127).copysign_(blocks)
+    return codes.to(torch.int8), scale
+
+
+def dequantize_signed(codes, scale):
+    values = codes.float()
+    return values.mul_(values.abs()).mul_((scale / 127**2)[:, None])
+
+
+def quantize_unsigned(blocks, dither):
+    """
+    Second moment blocks -> (uint8 codes, per-block max), companded through the 4th root (~10 decades)
+    A non-zero second moment keeps at least code 1, so it never decodes to zero and never divides by bare eps
+    """
+    scale = blocks.amax(dim=1)
+    levels = blocks.mul((255**4 / scale.clamp(min=1e-20))[:, None]).sqrt_().sqrt_()
+    min_codes = levels.ceil().clamp_(max=1)
+    codes = torch.maximum(_stochastic_round(levels, dither).clamp_(max=255), min_codes)
+    return codes.to(torch.uint8), scale
+
+
+def dequantize_unsigned(codes, scale):
+    return codes.float().square_().square_().mul_((scale / 255**4)[:, None])
+
+# ============================================================================
+# OPTIMIZERS
+# ============================================================================
+
+class AdamW8bit(torch.optim.Optimizer):
+    """
+    AdamW with both moments stored as block-wise 8-bit codes (QUANT_BLOCK elements per fp32 scale)
+    Each STEP_CHUNK piece is decoded to fp32, updated exactly like AdamW and re-encoded
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2):
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay))
+
+    @staticmethod
+    def state_bytes(params):
+        """Bytes of state step() will allocate for params: 8-bit codes plus two fp32 scales per block"""
+        total = 0
+        for p in params:
+            if p.numel() >= MIN_8BIT_NUMEL:
+                n_blocks = -(-p.numel() // QUANT_BLOCK)
+                total += n_blocks * (2 * QUANT_BLOCK + 2 * 4)
+            else:
+                total += 2 * 4 * p.numel()
+        return total
+
+    def load_state_dict(self, state_dict):
+        # Optimizer.load_state_dict casts every state tensor to its parameter's dtype; the codes are whole numbers
+        super().load_state_dict(state_dict)
+        for state in self.state.values():
+            if 'exp_avg_scale' in state:
+                state['exp_avg'] = state['exp_avg'].to(torch.int8)
+                state['exp_avg_sq'] = state['exp_avg_sq'].to(torch.uint8)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                quantized = p.numel() >= MIN_8BIT_NUMEL
+                if not state:
+                    state['step'] = torch.tensor(0.0)
+                    if quantized:
+                        n_blocks = -(-p.numel() // QUANT_BLOCK)
+                        state['exp_avg'] = torch.zeros(n_blocks, QUANT_BLOCK, dtype=torch.int8, device=p.device)
+                        state['exp_avg_scale'] = torch.zeros(n_blocks, device=p.device)
+                        state['exp_avg_sq'] = torch.zeros(n_blocks, QUANT_BLOCK, dtype=torch.uint8, device=p.device)
+                        state['exp_avg_sq_scale'] = torch.zeros(n_blocks, device=p.device)
+                    else:
+                        state['exp_avg'] = torch.zeros_like(p, dtype=torch.float32)
+                        state['exp_avg_sq'] = torch.zeros_like(p, dtype=torch.float32)
+                state['step'] += 1
+                step = state['step'].item()
+
+                if not quantized:
+                    grad = p.grad.float()
+                    state['exp_avg'].lerp_(grad, 1 - beta1)
+                    state['exp_avg_sq'].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                    _adamw_update(p, state['exp_avg'], state['exp_avg_sq'].clone(), step, group)
+                    continue
+
+                # Fresh rounding noise every step, one tile shared by all chunks (cheaper than per-element draws)
+                m_noise, v_noise = torch.rand(2, STEP_CHUNK // QUANT_BLOCK, QUANT_BLOCK, device=p.device)
+                param, grad = p.view(-1), p.grad.reshape(-1)
+                for start in range(0, param.numel(), STEP_CHUNK):
+                    end = min(start + STEP_CHUNK, param.numel())
+                    rows = slice(start // QUANT_BLOCK, -(-end // QUANT_BLOCK))
+                    g = _blocks(grad[start:end].float())
+                    exp_avg = dequantize_signed(state['exp_avg'][rows], state['exp_avg_scale'][rows])
+                    exp_avg_sq = dequantize_unsigned(state['exp_avg_sq'][rows], state['exp_avg_sq_scale'][rows])
+                    exp_avg.lerp_(g, 1 - beta1)
+                    exp_avg_sq.mul_(beta2).addcmul_(g, g, value=1 - beta2)
+                    state['exp_avg'][rows], state['exp_avg_scale'][rows] = quantize_signed(exp_avg, m_noise)
+                    state['exp_avg_sq'][rows], state['exp_avg_sq_scale'][rows] = quantize_unsigned(exp_avg_sq, v_noise)
+                    _adamw_update(param[start:end], exp_avg.view(-1)[:end - start],
+                                  exp_avg_sq.view(-1)[:end - start], step, group)
+        return loss
+
+
+class FactoredAdamW(torch.optim.Optimizer):
+    """
+    AdamW whose second moment is factored for 2-D parameters (Adafactor, Shazeer & Stern 2018):
+    exponential averages of the row and column means of grad^2, v ~ row x col / mean(row)
+    The first moment stays a full fp32 tensor; 1-D parameters keep AdamW's full second moment
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2):
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay))
+
+    @staticmethod
+    def state_bytes(params):
+        """Bytes of state step() will allocate for params: fp32 first moment, row + column (or full) second moment"""
+        return sum(4 * (p.numel() + (p.size(0) + p.size(1) if p.dim() == 2 else p.numel())) for p in params)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                factored = p.dim() == 2
+                if not state:
+                    state['step'] = torch.tensor(0.0)
+                    state['exp_avg'] = torch.zeros_like(p, dtype=torch.float32)
+                    if factored:
+                        state['exp_avg_sq_row'] = torch.zeros(p.size(0), device=p.device)
+                        state['exp_avg_sq_col'] = torch.zeros(p.size(1), device=p.device)
+                    else:
+                        state['exp_avg_sq'] = torch.zeros_like(p, dtype=torch.float32)
+                state['step'] += 1
+                step = state['step'].item()
+
+                if not factored:
+                    grad = p.grad.float()
+                    state['exp_avg'].lerp_(grad, 1 - beta1)
+                    state['exp_avg_sq'].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                    _adamw_update(p, state['exp_avg'], state['exp_avg_sq'].clone(), step, group)
+                    continue
+
+                # Pass 1: first moment and the row/column statistics of grad^2, a few rows at a time
+                exp_avg, row, col = state['exp_avg'], state['exp_avg_sq_row'], state['exp_avg_sq_col']
+                chunk_rows = max(1, STEP_CHUNK // p.size(1))
+                row_mean, col_sum = torch.empty_like(row), torch.zeros_like(col)
+                for start in range(0, p.size(0), chunk_rows):
+                    g = p.grad[start:start + chunk_rows].float()
+                    exp_avg[start:start + chunk_rows].lerp_(g, 1 - beta1)
+                    grad_sq = g.square_()
+                    row_mean[start:start + chunk_rows] = grad_sq.mean(dim=1)
+                    col_sum += grad_sq.sum(dim=0)
+                row.lerp_(row_mean, 1 - beta2)
+                col.lerp_(col_sum / p.size(0), 1 - beta2)
+
+                # Pass 2: the update, rebuilding v = row x col / mean(row) for the same rows
+                row_scale = 1 / row.mean().clamp(min=1e-30)
+                for start in range(0, p.size(0), chunk_rows):
+                    exp_avg_sq = torch.outer(row[start:start + chunk_rows] * row_scale, col)
+                    _adamw_update(p[start:start + chunk_rows], exp_avg[start:start + chunk_rows], exp_avg_sq,
+                                  step, group)
+        return loss
+
+
+def _adamw_update(param, exp_avg, exp_avg_sq, step, group):
+    """Decoupled weight decay and the bias-corrected Adam step, as in torch.optim.AdamW (consumes exp_avg_sq)"""
+    param.mul_(1 - group['lr'] * group['weight_decay'])
+    bias_correction1 = 1 - group['betas'][0] ** step
+    bias_correction2 = 1 - group['betas'][1] ** step
+    denom = exp_avg_sq.div_(bias_correction2).sqrt_().add_(group['eps'])
+    param.addcdiv_(exp_avg.to(param.dtype), denom.to(param.dtype), value=-group['lr'] / bias_correction1)
+
+
+def optimizer_state_bytes(optimizer):
+    """Bytes held by an optimizer's state tensors"""
+    return sum(t.numel() * t.element_size() for state in optimizer.state.values()
+               for t in state.values() if torch.is_tensor(t))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+sampling.py - Batch-aware Sampling for TinyGPT.generate
+Sampler turns last-position logits into next tokens, StopSequences ends rows early
+"""
+
+import torch
+import torch.nn.functional as F
+
+# ============================================================================
+# SAMPLER
+# ============================================================================
+
+class Sampler:
+    """
+    Pluggable next-token sampler: sampler(logits, idx, mask=None) -> (B, 1) token ids
+
+    temperature=0      -> argmax fast path, nothing else is computed
+    top_k              -> sample among the k best logits only (no full-vocabulary mask)
+    top_p              -> nucleus sampling, inside the top_k candidates when both are set
+    repetition_penalty -> shrink logits of tokens already present in the row (1.0 = off)
+    seeds              -> one generator per row, so a row samples the same tokens in any batch
+    """
+    def __init__(self, temperature=1.0, top_k=None, top_p=None, repetition_penalty=1.0, seeds=None):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.generators = None
+        if seeds is not None:
+            self.generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+
+    def _uniform(self, batch_size, device):
+        """One U[0, 1) draw per row"""
+        if self.generators is None:
+            return torch.rand(batch_size, 1, device=device)
+        assert len(self.generators) == batch_size, "Sampler needs one seed per row"
+        return torch.cat([torch.rand(1, 1, generator=g) for g in self.generators]).to(device)
+
+    def apply_repetition_penalty(self, logits, idx, mask=None):
+        """CTRL-style penalty: divide positive / multiply negative logits of tokens seen in idx"""
+        seen = torch.ones_like(idx, dtype=logits.dtype) if mask is None else mask.to(logits.dtype)
+        counts = torch.zeros_like(logits).scatter_add_(1, idx, seen)
+        penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+        return torch.where(counts > 0, penalized, logits)
+
+    def __call__(self, logits, idx=None, mask=None):
+        """logits: (B, V) last-position logits, idx: (B, T) tokens so far, mask: (B, T) False for padding"""
+        if self.repetition_penalty != 1.0 and idx is not None:
+            logits = self.apply_repetition_penalty(logits, idx, mask)
+        if self.temperature == 0:
+            return logits.argmax(dim=-1, keepdim=True)
+
+        logits = logits / self.temperature
+        candidates = None
+        if self.top_k is not None:
+            logits, candidates = torch.topk(logits, min(self.top_k, logits.size(-1)))  # sorted, descending
+        elif self.top_p is not None:
+            logits, candidates = torch.sort(logits, dim=-1, descending=True)
+        probs = F.softmax(logits, dim=-1)
+
+        if self.top_p is not None:
+            # Keep the smallest prefix whose mass reaches top_p (the best token always survives)
+            probs = probs.masked_fill(probs.cumsum(dim=-1) - probs >= self.top_p, 0.0)
+
+        # Inverse-CDF sampling: one uniform per row, no renormalization needed
+        cdf = probs.cumsum(dim=-1)
+        u = self._uniform(probs.size(0), probs.device) * cdf[:, -1:]
+        choice = (cdf < u).sum(dim=-1, keepdim=True).clamp(max=probs.size(-1) - 1)
+        return choice if candidates is None else candidates.gather(-1, choice)
+
+# ============================================================================
+# STOP SEQUENCES
+# ============================================================================
+
+class StopSequences:
+    """
+    Stop strings such as "\\n\\n" or "# File:", matched on the text each row generated (never the prompt)
+    stops: a string or list of strings shared by every row, or one list of strings per row
+    """
+    def __init__(self, tokenizer, stops):
+        self.tokenizer = tokenizer
+        if isinstance(stops, str):
+            stops = [stops]
+        self.shared = all(isinstance(s, str) for s in stops)
+        self.stops = stops
+        rows = [stops] if self.shared else stops
+        longest = max((len(s) for row in rows for s in row), default=0)
+        # A stop string of n characters overlaps at most 4n byte-level tokens
+        self.tail_tokens = 4 * longest
+
+    def for_row(self, row):
+        return self.stops if self.shared else self.stops[row]
+
+    def check(self, new_tokens):
+        """new_tokens: per-row generated ids (list of lists or a (B, n) tensor) -> (B,) bool tensor"""
+        done = []
+        for row, tokens in enumerate(new_tokens):
+            if torch.is_tensor(tokens):
+                tokens = tokens.tolist()
+            tail = self.tokenizer.decode(tokens[-self.tail_tokens:]) if tokens else ""
+            done.append(any(s in tail for s in self.for_row(row)))
+        return torch.tensor(done, dtype=torch.bool)
+
+    def truncate(self, text, row=0):
+        """Cut generated text right before the first stop string"""
+        cuts = [text.find(s) for s in self.for_row(row) if s in text]
+        return text[:min(cuts)] if cuts else text
@@ -7,8 +7,10 @@ Load your trained models and test them with new prompts
 import torch
 import json
 import os
+import time
 import tiktoken
 from train import TinyGPT
+from vocab import CompactVocab
 
 # ============================================================================
 # NEW TEST DATA - Different from training!
@@ -37,7 +39,7 @@ def load_model(model_filename):
     print(f"📂 Loading: {model_filename}")
     
     device = torch.device('cpu')
-    checkpoint = torch.load(model_filename, map_location=device)
+    checkpoint = torch.load(model_filename, map_location=device, weights_only=False)  # config is a pickled dataclass
     
     # Reconstruct model
     config = checkpoint['config']
@@ -81,29 +83,30 @@ def test_all_models():
         print(f"Model: {model_name} (trained on {dataset_size} tokens)")
         print(f"{'='*70}")
         
-        # Load model
+        # Load model (compact-vocabulary models bring their own id map)
         model, checkpoint = load_model(model_file)
+        tokenizer = CompactVocab.from_model(model, enc)
         
         results = {}
         
-        # Test with each new prompt
-        for prompt in NEW_TEST_PROMPTS:
+        # Test all new prompts in one left-padded batch
+        prompt_tokens = [tokenizer.encode_ordinary(prompt) for prompt in NEW_TEST_PROMPTS]
+        start_time = time.time()
+        new_tokens = model.generate_batch(prompt_tokens, max_new_tokens=40, temperature=0.8,
+                                          top_k=40, stop_token=tokenizer.eot_token)
+        elapsed = time.time() - start_time
+        
+        for prompt, tokens, generated in zip(NEW_TEST_PROMPTS, prompt_tokens, new_tokens):
+            output = tokenizer.decode(tokens + generated)
             print(f"\n🔹 Prompt: '{prompt}'")
-            
-            # Tokenize
-            tokens = enc.encode_ordinary(prompt)
-            context = torch.tensor(tokens, dtype=torch.long, device=device).unsqueeze(0)
-            
-            # Generate
-            with torch.no_grad():
-                generated = model.generate(context, max_new_tokens=40, 
-                                         temperature=0.8, top_k=40)
-            
-            output = enc.decode(generated.squeeze().tolist())
             print(f"   Output: {output}")
             
             results[prompt] = output
         
+        total_tokens = sum(len(t) for t in new_tokens)
+        print(f"\n⚡ {len(NEW_TEST_PROMPTS)} prompts, {total_tokens} tokens in {elapsed:.2f}s "
+              f"({total_tokens / elapsed:.1f} tok/s)")
+        
         all_results[model_name] = results
     
     # Save results
@@ -140,16 +143,17 @@ def compare_single_prompt(prompt="A magical wizard"):
         
         # Load
         model, _ = load_model(model_file)
+        tokenizer = CompactVocab.from_model(model, enc)
         
         # Generate
-        tokens = enc.encode_ordinary(prompt)
+        tokens = tokenizer.encode_ordinary(prompt)
         context = torch.tensor(tokens, dtype=torch.long, device=device).unsqueeze(0)
         
         with torch.no_grad():
             generated = model.generate(context, max_new_tokens=50, 
                                      temperature=0.8, top_k=40)
         
-        output = enc.decode(generated.squeeze().tolist())
+        output = tokenizer.decode(generated.squeeze().tolist())
         
         # Display
         print(f"\n📊 {model_name} ({dataset_size} tokens):")
@@ -183,7 +187,7 @@ def interactive_test():
     
     # Load selected model
     model, _ = load_model(model_info['filename'])
-    enc = tiktoken.get_encoding("gpt2")
+    enc = CompactVocab.from_model(model, tiktoken.get_encoding("gpt2"))
     device = torch.device('cpu')
     
     print(f"\n✅ Loaded: {model_info['name']}")
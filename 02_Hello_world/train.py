@@ -7,11 +7,23 @@ Import configurations from config.py
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.multiprocessing as mp
+import torch.distributed as dist
+from torch.utils.checkpoint import checkpoint
+from torch.nn.parallel import DistributedDataParallel as DDP
 import math
 import numpy as np
 from tqdm.auto import tqdm
 from contextlib import nullcontext
-import matplotlib.pyplot as plt
+from dataclasses import replace
+from matplotlib.figure import Figure
+import time
+import os
+import re
+import glob
+import resource
+import queue
+import threading
 
 # Import configurations
 from config import (
@@ -19,6 +31,9 @@ from config import (
     CONFIG_TINY, CONFIG_SMALL, CONFIG_MEDIUM, CONFIG_LARGE, CONFIG_XLARGE,
     get_sample_text, TEST_PROMPTS
 )
+from sampling import Sampler, StopSequences
+from vocab import CompactVocab, UNK_ID
+from optimizers import AdamW8bit, FactoredAdamW
 
 # ============================================================================
 # DATA PREPARATION
@@ -52,12 +67,46 @@ def create_tiny_dataset_from_text(text, config):
     print(f"   Val tokens   : {len(val_tokens)}")
     print(f"   Unique tokens: {len(set(tokens))}")
     
+    if config.compact_vocab:
+        # Dense ids for the tokens seen in training, anything only in val becomes UNK
+        enc = CompactVocab.from_tokens(enc, train_tokens)
+        train_tokens = enc.to_compact(train_tokens).astype(np.uint16)
+        val_tokens = enc.to_compact(val_tokens).astype(np.uint16)
+        print(f"   Compact vocab: {enc.n_vocab} ids (was {enc.tokenizer.n_vocab}), "
+              f"{int((val_tokens == UNK_ID).sum())} val tokens -> UNK")
+    
     return train_tokens, val_tokens, enc
 
 # ============================================================================
 # MODEL ARCHITECTURE
 # ============================================================================
 
+# F.scaled_dot_product_attention shares K/V heads across query groups itself from torch 2.5 (enable_gqa)
+SDPA_GQA = tuple(int(part) for part in torch.__version__.split('.')[:2]) >= (2, 5)
+
+class KVCache:
+    """
+    Per-layer key/value buffers for incremental decoding
+    Prefill writes the whole prompt once, each decode step appends one position
+    Holds n_kv_head heads per layer, so grouped-query models cache n_head // n_kv_head times less
+    """
+    def __init__(self, config, batch_size, device, dtype=torch.float32):
+        head_dim = config.n_embd // config.n_head
+        shape = (batch_size, getattr(config, 'n_kv_head', 0) or config.n_head, config.block_size, head_dim)
+        self.k = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.v = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.seq_len = 0
+
+    def update(self, layer_idx, k, v):
+        """Write new keys/values after the cached ones, return the filled part of the buffers"""
+        end = self.seq_len + k.size(2)
+        self.k[layer_idx][:, :, self.seq_len:end] = k
+        self.v[layer_idx][:, :, self.seq_len:end] = v
+        return self.k[layer_idx][:, :, :end], self.v[layer_idx][:, :, :end]
+
+    def reset(self):
+        self.seq_len = 0
+
 class LayerNorm(nn.Module):
     def __init__(self, ndim, bias):
         super().__init__()
@@ -68,37 +117,64 @@ class LayerNorm(nn.Module):
         return F.layer_norm(x, self.weight.shape, self.weight, self.bias, 1e-5)
 
 class CausalSelfAttention(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         assert config.n_embd % config.n_head == 0
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=True)
+        # Grouped-query attention: n_head query heads share n_kv_head key/value heads (1 = multi-query)
+        self.n_kv_head = getattr(config, 'n_kv_head', 0) or config.n_head
+        assert config.n_head % self.n_kv_head == 0
+        self.kv_dim = config.n_embd // config.n_head * self.n_kv_head
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * self.kv_dim, bias=True)
         self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=True)
         self.attn_dropout = nn.Dropout(config.dropout)
         self.resid_dropout = nn.Dropout(config.dropout)
         self.n_head = config.n_head
         self.n_embd = config.n_embd
+        self.layer_idx = layer_idx
         self.flash = hasattr(F, 'scaled_dot_product_attention')
         if not self.flash:
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                        .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        """attn_mask: optional (B, 1, T, T_k) bool mask, True = may attend; already includes causality"""
         B, T, C = x.size()
-        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        q, k, v = self.c_attn(x).split([self.n_embd, self.kv_dim, self.kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        v = v.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2)
+
+        if kv_cache is not None:
+            k, v = kv_cache.update(self.layer_idx, k, v)
+        T_k = k.size(2)  # queries are the last T of T_k positions
 
         if self.flash:
-            y = F.scaled_dot_product_attention(q, k, v, attn_mask=None, 
+            # is_causal aligns the mask top-left, so it only fits when there is no cached prefix
+            is_causal = attn_mask is None and T > 1 and T == T_k
+            if attn_mask is None and T > 1 and T != T_k:
+                attn_mask = torch.ones(T, T_k, dtype=torch.bool, device=x.device).tril(diagonal=T_k - T)
+            gqa = {}
+            if self.n_kv_head != self.n_head:
+                if SDPA_GQA:
+                    gqa = {'enable_gqa': True}
+                else:  # older torch: every query head gets its own copy of the shared K/V head
+                    k = k.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+                    v = v.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, 
                                               dropout_p=self.attn_dropout.p if self.training else 0.0, 
-                                              is_causal=True)
+                                              is_causal=is_causal, **gqa)
         else:
+            # The query heads sharing a K/V head are folded into its query rows: (B, n_kv_head, group * T, hs)
+            q = q.reshape(B, self.n_kv_head, -1, k.size(-1))
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:, :, :T, :T] == 0, float('-inf'))
+            att = att.view(B, self.n_kv_head, -1, T, T_k)
+            if attn_mask is not None:
+                att = att.masked_fill(~attn_mask.unsqueeze(2), float('-inf'))
+            else:
+                att = att.masked_fill(self.bias[:, :, T_k - T:T_k, :T_k] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
-            y = att @ v
+            y = (att.view(B, self.n_kv_head, -1, T_k) @ v).view(B, self.n_head, T, -1)
 
         y = y.transpose(1, 2).contiguous().view(B, T, C)
         y = self.resid_dropout(self.c_proj(y))
@@ -116,18 +192,66 @@ class MLP(nn.Module):
         return self.dropout(self.c_proj(self.gelu(self.c_fc(x))))
 
 class Block(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln1 = LayerNorm(config.n_embd, bias=True)
-        self.attn = CausalSelfAttention(config)
+        self.attn = CausalSelfAttention(config, layer_idx)
         self.ln2 = LayerNorm(config.n_embd, bias=True)
         self.mlp = MLP(config)
     
-    def forward(self, x):
-        x = x + self.attn(self.ln1(x))
+    def forward(self, x, kv_cache=None, attn_mask=None):
+        x = x + self.attn(self.ln1(x), kv_cache=kv_cache, attn_mask=attn_mask)
         x = x + self.mlp(self.ln2(x))
         return x
 
+class ChunkedLMHeadLoss(torch.autograd.Function):
+    """
+    Mean cross-entropy of x @ weight.T (targets of -1 ignored) without a (tokens, vocab) logits tensor
+    Forward keeps only each row's logsumexp, backward recomputes the logits chunk by chunk
+    """
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size):
+        # Under autocast both passes run in the autocast dtype, so backward sees the logits forward saw
+        dtype = torch.get_autocast_dtype(x.device.type) if torch.is_autocast_enabled(x.device.type) else x.dtype
+        acc_dtype = torch.promote_types(dtype, torch.float32)  # softmax statistics: at least fp32, fp64 stays fp64
+        with torch.autocast(x.device.type, enabled=False):
+            w = weight.to(dtype)
+            lse = torch.empty(x.size(0), dtype=acc_dtype, device=x.device)
+            target_logits = torch.empty_like(lse)
+            for start in range(0, x.size(0), chunk_size):
+                end = start + chunk_size
+                logits = (x[start:end].to(dtype) @ w.t()).to(acc_dtype)
+                lse[start:end] = torch.logsumexp(logits, dim=-1)
+                target_logits[start:end] = logits.gather(1, targets[start:end].clamp(min=0)[:, None]).squeeze(1)
+        valid = targets != -1
+        ctx.save_for_backward(x, weight, targets, lse)
+        ctx.chunk_size, ctx.dtype = chunk_size, dtype
+        return torch.where(valid, lse - target_logits, 0.0).sum() / valid.sum()
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        x, weight, targets, lse = ctx.saved_tensors
+        valid = targets != -1
+        # d loss / d logits = (softmax - one_hot) / n_valid, zero for ignored rows
+        row_scale = valid.to(lse.dtype) * (grad_loss / valid.sum())
+        grad_x = torch.empty_like(x)
+        grad_w = torch.zeros_like(weight)
+        with torch.autocast(x.device.type, enabled=False):
+            w = weight.to(ctx.dtype)
+            for start in range(0, x.size(0), ctx.chunk_size):
+                end = start + ctx.chunk_size
+                x_chunk = x[start:end].to(ctx.dtype)
+                grad_logits = (x_chunk @ w.t()).to(lse.dtype).sub_(lse[start:end, None]).exp_()
+                rows = torch.arange(grad_logits.size(0), device=x.device)
+                grad_logits[rows, targets[start:end].clamp(min=0)] -= 1
+                grad_logits = grad_logits.mul_(row_scale[start:end, None]).to(ctx.dtype)
+                grad_x[start:end] = grad_logits @ w
+                if grad_w.dtype == ctx.dtype:
+                    grad_w.addmm_(grad_logits.t(), x_chunk)
+                else:
+                    grad_w += grad_logits.t() @ x_chunk
+        return grad_x, grad_w, None, None
+
 class TinyGPT(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -136,11 +260,14 @@ class TinyGPT(nn.Module):
             wte=nn.Embedding(config.vocab_size, config.n_embd),
             wpe=nn.Embedding(config.block_size, config.n_embd),
             drop=nn.Dropout(config.dropout),
-            h=nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h=nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f=LayerNorm(config.n_embd, bias=True),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
         self.transformer.wte.weight = self.lm_head.weight  # weight tying
+        if getattr(config, 'compact_vocab', False):
+            # Tokenizer id of every compact id, saved with the weights (see vocab.py)
+            self.register_buffer('vocab_map', torch.full((config.vocab_size,), -1, dtype=torch.long))
 
         self.apply(self._init_weights)
         for pn, p in self.named_parameters():
@@ -159,65 +286,320 @@ class TinyGPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, padding_mask=None, all_logits=False):
+        """
+        padding_mask: optional (b, start + t) bool mask over cached + new positions,
+        False marks left padding. Real tokens get positions counted from their own row start.
+        all_logits: without targets, return logits for every position instead of only the last;
+        with targets, also return the full logits (otherwise None, the loss never materializes them)
+        """
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size
-        pos = torch.arange(0, t, dtype=torch.long, device=device)
+        start = kv_cache.seq_len if kv_cache is not None else 0
+        assert start + t <= self.config.block_size
+        attn_mask = None
+        if padding_mask is None:
+            pos = torch.arange(start, start + t, dtype=torch.long, device=device)
+        else:
+            pos = (padding_mask.long().cumsum(-1) - 1).clamp(min=0)[:, start:]
+            q_pos = torch.arange(start, start + t, device=device).view(-1, 1)
+            k_pos = torch.arange(start + t, device=device).view(1, -1)
+            # Every query may see itself, so padded rows never softmax over an empty set
+            attn_mask = (k_pos <= q_pos) & (padding_mask[:, None, :] | (k_pos == q_pos))
+            attn_mask = attn_mask.unsqueeze(1)
 
         tok_emb = self.transformer.wte(idx)
         pos_emb = self.transformer.wpe(pos)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        # Checkpointed blocks keep only their input; backward reruns them (same dropout masks) to rebuild activations
+        checkpoint_every = getattr(self.config, 'activation_checkpointing', 0)
+        checkpointing = checkpoint_every and self.training and torch.is_grad_enabled() and kv_cache is None
+        for i, block in enumerate(self.transformer.h):
+            if checkpointing and i % checkpoint_every == 0:
+                x = checkpoint(block, x, attn_mask=attn_mask, use_reentrant=False)
+            else:
+                x = block(x, kv_cache=kv_cache, attn_mask=attn_mask)
         x = self.transformer.ln_f(x)
+        if kv_cache is not None:
+            kv_cache.seq_len += t
 
         if targets is not None:
-            logits = self.lm_head(x)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
-            return logits, loss
+            chunk_size = getattr(self.config, 'loss_chunk_tokens', 0)
+            if all_logits or not chunk_size or b * t <= chunk_size:
+                logits = self.lm_head(x)
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+                return (logits if all_logits else None), loss
+            # Projection + cross-entropy chunk by chunk: peak memory holds chunk_size x vocab logits, not b x t x vocab
+            loss = ChunkedLMHeadLoss.apply(x.reshape(b * t, -1), self.lm_head.weight, targets.reshape(-1), chunk_size)
+            return None, loss
         else:
-            logits = self.lm_head(x[:, [-1], :])
+            logits = self.lm_head(x if all_logits else x[:, [-1], :])
             return logits, None
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def prefill(self, idx, kv_cache, padding_mask=None):
+        """Encode the whole context once, filling the cache from position 0"""
+        kv_cache.reset()
+        logits, _ = self(idx, kv_cache=kv_cache, padding_mask=padding_mask)
+        return logits
+
+    @torch.no_grad()
+    def decode_step(self, idx_next, kv_cache, padding_mask=None):
+        """Encode one new token per row, attending to the cached keys/values"""
+        logits, _ = self(idx_next, kv_cache=kv_cache, padding_mask=padding_mask)
+        return logits
+
+    def _cache_dtype(self, device):
+        """KV cache dtype: the autocast dtype when generating under autocast (what attention consumes), else the weights'"""
+        if torch.is_autocast_enabled(device.type):
+            return torch.get_autocast_dtype(device.type)
+        return self.transformer.wpe.weight.dtype
+
+    def _check_window_shift(self, window_shift):
+        if window_shift is not None and not 0 < window_shift < self.config.block_size:
+            raise ValueError(f"window_shift must be in (0, {self.config.block_size}), got {window_shift}")
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_cache=True, window_shift=None,
+                 sampler=None, stop=None):
+        """
+        window_shift: long-form mode for generations past block_size. Once the cache is full,
+        drop the oldest window_shift tokens and re-encode the rest once (positions restart at 0),
+        then keep decoding from the cache. None re-encodes the cropped window on every step.
+        sampler: callable (logits, idx) -> next tokens, defaults to Sampler(temperature, top_k)
+        stop: optional StopSequences; generation ends early once every row has produced one
+        """
+        self._check_window_shift(window_shift)
+        sampler = sampler or Sampler(temperature, top_k)
+        prompt_len = idx.size(1)
+        kv_cache = None
+        if use_cache:
+            kv_cache = KVCache(self.config, idx.size(0), idx.device, self._cache_dtype(idx.device))
         for _ in range(max_new_tokens):
             idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            logits, _ = self(idx_cond)
-            logits = logits[:, -1, :] / temperature
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            probs = F.softmax(logits, dim=-1)
-            idx_next = torch.multinomial(probs, num_samples=1)
+            if kv_cache is None:
+                logits, _ = self(idx_cond)
+            elif 0 < kv_cache.seq_len < self.config.block_size:
+                logits = self.decode_step(idx[:, -1:], kv_cache)
+            elif kv_cache.seq_len > 0 and window_shift is not None:
+                logits = self.prefill(idx[:, -(self.config.block_size - window_shift):], kv_cache)
+            else:
+                # First step, or the window is full and positions shift: re-encode the cropped context
+                logits = self.prefill(idx_cond, kv_cache)
+            idx_next = sampler(logits[:, -1, :], idx)
             idx = torch.cat((idx, idx_next), dim=1)
+            if stop is not None and stop.check(idx[:, prompt_len:]).all():
+                break
         return idx
 
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=None, stop_token=None, pad_token=0,
+                       window_shift=None, sampler=None, stop=None):
+        """
+        Generate for a list of token lists of different lengths in one batch
+        Prompts are left-padded and masked; each row stops on its own at stop_token or at one of its
+        stop sequences (the token completing a stop string is kept, cut the text with stop.truncate)
+        window_shift, sampler and stop work as in generate()
+        Returns one list of new tokens per prompt (stop_token excluded)
+        """
+        self._check_window_shift(window_shift)
+        sampler = sampler or Sampler(temperature, top_k)
+        device = self.transformer.wpe.weight.device
+        block_size = self.config.block_size
+        B, max_len = len(prompts), max(len(p) for p in prompts)
+        idx = torch.full((B, max_len), pad_token, dtype=torch.long, device=device)
+        mask = torch.zeros((B, max_len), dtype=torch.bool, device=device)
+        for i, p in enumerate(prompts):
+            idx[i, max_len - len(p):] = torch.tensor(p, dtype=torch.long, device=device)
+            mask[i, max_len - len(p):] = True
+
+        kv_cache = KVCache(self.config, B, device, self._cache_dtype(device))
+        finished = torch.zeros(B, dtype=torch.bool, device=device)
+        for _ in range(max_new_tokens):
+            if 0 < kv_cache.seq_len < block_size:
+                logits = self.decode_step(idx[:, -1:], kv_cache, mask[:, -(kv_cache.seq_len + 1):])
+            elif kv_cache.seq_len > 0 and window_shift is not None:
+                keep = block_size - window_shift
+                logits = self.prefill(idx[:, -keep:], kv_cache, mask[:, -keep:])
+            else:
+                logits = self.prefill(idx[:, -block_size:], kv_cache, mask[:, -block_size:])
+            idx_next = sampler(logits[:, -1, :], idx, mask)
+            # Finished rows keep running as masked padding until the whole batch is done
+            idx_next = idx_next.masked_fill(finished[:, None], pad_token)
+            idx = torch.cat((idx, idx_next), dim=1)
+            mask = torch.cat((mask, ~finished[:, None]), dim=1)
+            if stop_token is not None:
+                finished |= idx_next[:, 0] == stop_token
+            if stop is not None:
+                new_tokens = [idx[i, max_len:][mask[i, max_len:]] for i in range(B)]
+                finished |= stop.check(new_tokens).to(device)
+            if finished.all():
+                break
+
+        outputs = []
+        for i in range(B):
+            new_tokens = idx[i, max_len:][mask[i, max_len:]].tolist()
+            if stop_token is not None and stop_token in new_tokens:
+                new_tokens = new_tokens[:new_tokens.index(stop_token)]
+            outputs.append(new_tokens)
+        return outputs
+
 # ============================================================================
 # TRAINING UTILITIES
 # ============================================================================
 
+class BatchLoader:
+    """
+    Random (x, y) batches read straight from the token array (a uint16 np.memmap stays a memmap, no private copy)
+    A batch is one gather of block_size + 1 token windows into a small token-dtype buffer, cast to int64 into
+    preallocated tensors - valid until the next get_batch() call
+    """
+    def __init__(self, data, block_size, batch_size, device, rng=None):
+        self.num_source_tokens = len(data)  # tokens[:num_source_tokens] is the untiled split
+        if len(data) <= block_size:
+            # Dataset too small, repeat it (once, not on every batch)
+            data = np.tile(data, (block_size // len(data)) + 2)
+        self.num_tokens = len(data)
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.device = device
+        self.rng = rng or np.random  # a private RandomState keeps the batch order independent of other users
+        self.tokens = np.asarray(data)  # no copy for arrays and memmaps: loaders over one split share its pages
+        self.offsets = np.arange(block_size + 1)  # x is a window's first block_size tokens, y its last
+        self.gathered = np.empty((batch_size, block_size + 1), dtype=self.tokens.dtype)
+        self.x = torch.empty(batch_size, block_size, dtype=torch.long)
+        self.y = torch.empty(batch_size, block_size, dtype=torch.long)
+        if device != 'cpu':
+            self.x_device = torch.empty_like(self.x, device=device)
+            self.y_device = torch.empty_like(self.y, device=device)
+    
+    def __len__(self):
+        return self.num_tokens
+    
+    def sample_into(self, x, y):
+        """Fill the CPU tensors x and y with a random batch"""
+        ix = self.rng.randint(0, self.num_tokens - self.block_size, (self.batch_size,))
+        # Flat token indices: np.take on a strided window view would first copy the whole view
+        np.take(self.tokens, ix[:, None] + self.offsets, out=self.gathered)
+        np.copyto(x.numpy(), self.gathered[:, :-1])  # only the batch is cast to int64
+        np.copyto(y.numpy(), self.gathered[:, 1:])
+        return x, y
+    
+    def skip(self, num_batches):
+        """Advance the RNG past num_batches batches without gathering them (used when resuming)"""
+        for _ in range(num_batches):
+            self.rng.randint(0, self.num_tokens - self.block_size, (self.batch_size,))
+    
+    def get_batch(self):
+        self.sample_into(self.x, self.y)
+        if self.device == 'cpu':
+            return self.x, self.y
+        return self.x_device.copy_(self.x), self.y_device.copy_(self.y)
+
+class BatchPrefetcher:
+    """
+    Background thread keeping up to `depth` ready (X, y) batches from a BatchLoader in a bounded queue
+    Batches are written into a ring of preallocated buffers (pinned on CUDA, copied with non_blocking=True)
+    """
+    def __init__(self, loader, num_batches, depth=2):
+        self.loader = loader
+        self.device = loader.device
+        pin = self.device != 'cpu'
+        # depth queued + one being filled + one in use by the trainer
+        self.slots = [tuple(torch.empty(loader.batch_size, loader.block_size, dtype=torch.long, pin_memory=pin)
+                            for _ in range(2)) for _ in range(depth + 2)]
+        self.copy_done = [None] * len(self.slots)
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._produce, args=(num_batches,), daemon=True)
+        self.thread.start()
+    
+    def _produce(self, num_batches):
+        try:
+            for i in range(num_batches):
+                slot = i % len(self.slots)
+                if self.copy_done[slot] is not None:
+                    self.copy_done[slot].synchronize()  # the last host-to-device copy out of this buffer finished
+                self.queue.put((slot, self.loader.sample_into(*self.slots[slot])))
+        except Exception as e:
+            self.queue.put((None, e))
+    
+    def get_batch(self):
+        slot, batch = self.queue.get()
+        if slot is None:
+            raise batch
+        if self.device == 'cpu':
+            return batch
+        x, y = (t.to(self.device, non_blocking=True) for t in batch)
+        self.copy_done[slot] = torch.cuda.Event()
+        self.copy_done[slot].record()
+        return x, y
+
 def get_batch(data, block_size, batch_size, device):
     """Get a random batch from data"""
-    if len(data) <= block_size:
-        # Dataset too small, repeat it
-        data = np.tile(data, (block_size // len(data)) + 2)
+    if not isinstance(data, BatchLoader):
+        data = BatchLoader(data, block_size, batch_size, device)  # one-off; keep a BatchLoader for repeated batches
+    return data.get_batch()
+
+@torch.inference_mode()
+def evaluate_full(model, data, config, device, ctx, batch_size=None, stride=None):
+    """
+    Deterministic pass over a whole split (BatchLoader or token array) with block_size windows `stride` apart
+    (default: non-overlapping). Every target token is scored exactly once - targets a previous window already
+    covered are masked with ignore_index - so the loss is exactly token-weighted
+    Returns {'loss', 'perplexity', 'tokens'}
+    """
+    if isinstance(data, BatchLoader):
+        tokens = data.tokens[:data.num_source_tokens]
+    else:
+        tokens = np.asarray(data)
+    num_targets = len(tokens) - 1
+    if num_targets < 1:
+        return {'loss': float('inf'), 'perplexity': float('inf'), 'tokens': 0}
+    batch_size = batch_size or config.eval_batch_size
+    block_size = min(config.block_size, num_targets)
+    stride = min(stride or block_size, block_size)
     
-    ix = np.random.randint(0, len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy(data[i:i+block_size].astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy(data[i+1:i+1+block_size].astype(np.int64)) for i in ix])
-    return x.to(device), y.to(device)
+    # Window starts every `stride` tokens, plus one window flush with the end of the split
+    starts = list(range(0, num_targets - block_size + 1, stride))
+    if starts[-1] + block_size < num_targets:
+        starts.append(num_targets - block_size)
+    starts = torch.tensor(starts)
+    covered = torch.cat([torch.zeros(1, dtype=torch.long), starts[:-1] + block_size])  # scored by earlier windows
+    offsets = torch.arange(block_size)
+    
+    total_loss, total_tokens = 0.0, 0
+    for i in range(0, len(starts), batch_size):
+        positions = starts[i:i + batch_size, None] + offsets
+        X = torch.from_numpy(tokens[positions.numpy()].astype(np.int64))
+        Y = torch.from_numpy(tokens[positions.numpy() + 1].astype(np.int64))
+        Y = Y.masked_fill(positions < covered[i:i + batch_size, None], -1)
+        num_scored = int((Y != -1).sum())
+        with ctx:
+            _, loss = model(X.to(device), Y.to(device))
+        total_loss += loss.item() * num_scored
+        total_tokens += num_scored
+    
+    mean_loss = total_loss / total_tokens
+    return {'loss': mean_loss, 'perplexity': math.exp(mean_loss), 'tokens': total_tokens}
 
 @torch.no_grad()
 def estimate_loss(model, train_data, val_data, config, device, ctx, eval_iters=20):
-    """Estimate train and validation loss"""
+    """
+    Estimate train and validation loss (train_data/val_data: BatchLoaders or token arrays)
+    With config.eval_mode == 'full' the val loss is an exact full pass (see evaluate_full), plus val_perplexity
+    """
     out = {}
     model.eval()
     for split, data in [('train', train_data), ('val', val_data)]:
+        if split == 'val' and config.eval_mode == 'full':
+            full = evaluate_full(model, data, config, device, ctx)
+            out['val'], out['val_perplexity'] = full['loss'], full['perplexity']
+            continue
+        if not isinstance(data, BatchLoader):
+            data = BatchLoader(data, config.block_size, config.batch_size, device)
         losses = []
         for _ in range(min(eval_iters, max(1, len(data) // config.block_size))):
-            X, Y = get_batch(data, config.block_size, config.batch_size, device)
+            X, Y = data.get_batch()
             with ctx:
                 _, loss = model(X, Y)
             losses.append(loss.item())
@@ -225,12 +607,399 @@ def estimate_loss(model, train_data, val_data, config, device, ctx, eval_iters=2
     model.train()
     return out
 
+def cpu_bf16_supported():
+    """
+    True when the CPU has native bf16 matmuls (AVX512-BF16 or AMX)
+    Elsewhere bf16 autocast still runs, emulated, and is slower than plain fp32
+    """
+    if hasattr(torch.cpu, '_is_avx512_bf16_supported'):
+        return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+def cpu_autocast(enabled=True):
+    """
+    CPU mixed precision: bf16 autocast for matmuls/attention, while the weights (the optimizer's
+    master copy) stay fp32 and cross_entropy returns an fp32 loss; fp32 when disabled or unsupported
+    """
+    if enabled and cpu_bf16_supported():
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return nullcontext()
+
+def setup_distributed():
+    """
+    (rank, world_size) of this process; under torchrun (WORLD_SIZE > 1) it first joins the gloo process group
+    Plain single-process runs return (0, 1) and never touch torch.distributed
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend='gloo')
+    return dist.get_rank(), dist.get_world_size()
+
+COMPILE_CACHE_DIR = 'compile_cache'
+
+def enable_compile_cache(cache_dir=COMPILE_CACHE_DIR):
+    """
+    Keep inductor's compiled graphs and kernels on disk (FX graph cache), so the next run of a script
+    reuses them instead of compiling again; an explicit TORCHINDUCTOR_CACHE_DIR wins
+    """
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+
+def compile_decode_step(model):
+    """
+    Compile the single-token decode step used by generate/generate_batch, in place
+    dynamic=True traces the cache length symbolically: one graph for every prompt length and position
+    """
+    enable_compile_cache()
+    model.decode_step = torch.compile(model.decode_step, dynamic=True)
+    return model
+
+def reset_peak_memory(device):
+    """Restart peak tracking at the current usage (Linux peak RSS can be reset through /proc, since kernel 4.0)"""
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    elif os.path.exists('/proc/self/clear_refs'):
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+def peak_memory_mb(device):
+    """Peak memory of this process since the last reset_peak_memory: the CUDA allocator's peak, or peak RSS on CPU"""
+    if device == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2**20
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # whole-process peak, never reset
+
+def default_memory_budget_mb(device, world_size=1):
+    """80% of the GPU's memory, or of physical RAM shared by the local ranks"""
+    if device == 'cuda':
+        return 0.8 * torch.cuda.get_device_properties(0).total_memory / 2**20
+    total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return 0.8 * total / 2**20 / int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+
+def probe_micro_batch(model, config, device, ctx, max_batch, budget_mb, per_sequence_mb=0.0):
+    """
+    Largest micro-batch (sequences, <= max_batch) whose forward/backward peak stays within budget_mb
+    Probes 1, 2, 4, ..., max_batch and stops before a size whose peak, extrapolated from the last two probes,
+    would not fit; returns (micro_batch, [(batch, peak_mb), ...]), the torch RNG and the gradients are left untouched
+    per_sequence_mb: memory per sequence allocated outside the probed step (batch buffers), added to every peak
+    """
+    sizes = [1 << i for i in range(max_batch.bit_length()) if 1 << i < max_batch] + [max_batch]
+    rng_state = torch.get_rng_state()
+    micro_batch, probes = 1, []
+    for size in sizes:
+        if len(probes) >= 2:
+            (prev_size, prev_peak), (last_size, last_peak) = probes[-2:]
+            slope = (last_peak - prev_peak) / (last_size - prev_size)
+            if last_peak + slope * (size - last_size) > budget_mb:
+                break
+        reset_peak_memory(device)
+        X = torch.randint(0, config.vocab_size, (size, config.block_size), device=device)
+        with ctx:
+            _, loss = model(X, X)
+        loss.backward()
+        del loss
+        model.zero_grad(set_to_none=True)
+        probes.append((size, peak_memory_mb(device) + per_sequence_mb * size))
+        if probes[-1][1] > budget_mb:
+            break
+        micro_batch = size
+    torch.set_rng_state(rng_state)
+    return micro_batch, probes
+
+def data_pipeline_memory_mb(model, config, train_data, val_data):
+    """
+    Memory the batch-size probes cannot see, since they run before the loaders and the async eval worker exist:
+    (fixed MB, MB per sequence of micro-batch)
+    """
+    # Memmapped splits join the RSS page by page as they are read; in-memory splits are already in the probed peaks
+    fixed_mb = sum(data.nbytes for data in (train_data, val_data) if isinstance(data, np.memmap)) / 2**20
+    # int64 x/y batches of the three BatchLoaders (train, val, training batches) and of the prefetcher's slots
+    num_buffers = 3 + (config.prefetch_batches + 2 if config.prefetch_batches > 0 else 0)
+    per_sequence_mb = num_buffers * 2 * config.block_size * 8 / 2**20
+    if config.async_eval:
+        # The worker process holds its own copy of both splits, a model and two loaders; the trainer keeps up to
+        # ASYNC_EVAL_MAX_PENDING + 1 snapshots in flight
+        param_mb = sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+        fixed_mb += sum(np.asarray(data).nbytes for data in (train_data, val_data)) / 2**20
+        fixed_mb += (ASYNC_EVAL_MAX_PENDING + 2) * param_mb
+        per_sequence_mb += 2 * 2 * config.block_size * 8 / 2**20
+    return fixed_mb, per_sequence_mb
+
+def sized_max_iters(config, accumulation):
+    """config.max_iters in micro-steps of the given accumulation count (the same number of optimizer steps)"""
+    return config.max_iters // config.gradient_accumulation_steps * accumulation
+
+def plan_micro_batches(model, config, device, ctx, world_size=1, planned=None, train_data=None, val_data=None):
+    """
+    Auto batch sizing: (config, record) with batch_size and gradient_accumulation_steps chosen so that one
+    optimizer step sees config.auto_batch_tokens tokens (over all ranks) in micro-batches that fit memory_budget_mb
+    max_iters, eval_interval and checkpoint_interval count micro-steps, so they are rescaled: the run keeps the
+    hand-picked config's number of optimizer steps and eval/checkpoint schedule
+    planned: the sized config of the run being resumed, whose micro-batch and accumulation are reused as they were
+    train_data/val_data: the splits train_slm will load, so the data pipeline's memory is reserved from the budget
+    """
+    target_batch = max(1, config.auto_batch_tokens // (config.block_size * world_size))  # sequences per rank
+    budget_mb = config.memory_budget_mb or default_memory_budget_mb(device, world_size)
+    if planned is not None:
+        micro_batch, probes, fits = planned.batch_size, [], True
+    else:
+        # The optimizer allocates its state on the first step, after the probes: AdamW two moments per parameter,
+        # the low-memory optimizers what their state_bytes() reports
+        if config.optimizer in LOW_MEMORY_OPTIMIZERS:
+            optimizer_mb = LOW_MEMORY_OPTIMIZERS[config.optimizer].state_bytes(model.parameters()) / 2**20
+        else:
+            optimizer_mb = 2 * sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+        pipeline_mb, per_sequence_mb = (data_pipeline_memory_mb(model, config, train_data, val_data)
+                                        if train_data is not None else (0.0, 0.0))
+        probe_budget_mb = budget_mb - optimizer_mb - pipeline_mb
+        record = [None]
+        if not dist.is_initialized() or dist.get_rank() == 0:
+            record = [probe_micro_batch(model, config, device, ctx, target_batch, probe_budget_mb, per_sequence_mb)]
+        if dist.is_initialized():
+            dist.broadcast_object_list(record, src=0)  # every rank trains with rank 0's plan
+        micro_batch, probes = record[0]
+        fits = probes[0][1] <= probe_budget_mb  # micro_batch is 1 either way, but it may not fit
+    accumulation = planned.gradient_accumulation_steps if planned is not None else -(-target_batch // micro_batch)
+    micro_batch = -(-target_batch // accumulation)  # the same accumulation count with evenly sized micro-batches
+
+    scale = accumulation / config.gradient_accumulation_steps
+    checkpoint_interval = max(1, round(config.checkpoint_interval * scale)) if config.checkpoint_interval else 0
+    sized = replace(config, batch_size=micro_batch, gradient_accumulation_steps=accumulation,
+                    max_iters=sized_max_iters(config, accumulation),
+                    eval_interval=max(1, round(config.eval_interval * scale)), checkpoint_interval=checkpoint_interval)
+    record = {'target_tokens': config.auto_batch_tokens, 'budget_mb': budget_mb, 'micro_batch': micro_batch,
+              'gradient_accumulation_steps': accumulation,
+              'tokens_per_step': micro_batch * accumulation * config.block_size * world_size,
+              'probes': probes, 'fits': fits, 'resumed': planned is not None}
+    return sized, record
+
+LOW_MEMORY_OPTIMIZERS = {'adamw8bit': AdamW8bit, 'factored': FactoredAdamW}
+
+def make_optimizer(model, config):
+    """
+    AdamW for train_slm, the fused kernel where this torch/device supports it, else the foreach one
+    config.optimizer 'adamw8bit' / 'factored' trade the fp32 moments for a low-memory variant (same hyperparameters)
+    """
+    kwargs = dict(lr=config.learning_rate, betas=(0.9, 0.95), weight_decay=0.1, eps=1e-9)
+    if config.optimizer in LOW_MEMORY_OPTIMIZERS:
+        return LOW_MEMORY_OPTIMIZERS[config.optimizer](model.parameters(), **kwargs)
+    if config.optimizer != 'adamw':
+        raise ValueError(f"unknown optimizer {config.optimizer!r}, expected 'adamw', 'adamw8bit' or 'factored'")
+    try:
+        return torch.optim.AdamW(model.parameters(), fused=True, **kwargs)
+    except (RuntimeError, TypeError):
+        return torch.optim.AdamW(model.parameters(), foreach=True, **kwargs)
+
+def cpu_copy(obj):
+    """Detached CPU copy of every tensor in a (nested) dict/list, e.g. an optimizer state_dict"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+def cpu_state_dict(model):
+    """Detached CPU copy of the weights, safe to hand to another thread or process while training goes on"""
+    return cpu_copy(model.state_dict())
+
+def training_state_progress(path):
+    """(iteration a saved training state resumes from, the config it was saved with), or None if there is none"""
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location='cpu', weights_only=False, mmap=True)
+    return state['iter_num'], state['config']
+
+def _eval_worker(config, train_data, val_data, num_threads, tasks, results):
+    """AsyncEvaluator process: load each snapshot into a CPU model and run estimate_loss on it"""
+    torch.set_num_threads(num_threads)
+    np.random.seed(config.seed)
+    model = TinyGPT(config)
+    train_loader = BatchLoader(train_data, config.block_size, config.batch_size, 'cpu')
+    val_loader = BatchLoader(val_data, config.block_size, config.batch_size, 'cpu')
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        iter_num, state_dict = task
+        try:
+            model.load_state_dict(state_dict)
+            results.put((iter_num, estimate_loss(model, train_loader, val_loader, config, 'cpu',
+                                                 cpu_autocast(config.cpu_bf16))))
+        except Exception as e:
+            results.put((iter_num, e))
+
+ASYNC_EVAL_MAX_PENDING = 2  # snapshots queued for the async eval worker before poll() waits
+ASYNC_EVAL_POLL_SECONDS = 1.0  # how often a waiting poll() checks that the worker is still alive
+
+class AsyncEvaluator:
+    """
+    Scores state_dict snapshots in a separate worker process (own torch thread budget) while training continues
+    submit() copies the weights, poll() returns finished (iter_num, losses, snapshot) in submission order
+    At most max_pending snapshots are in flight, beyond that poll() waits for the worker
+    """
+    def __init__(self, config, train_data, val_data, num_threads=1, max_pending=ASYNC_EVAL_MAX_PENDING):
+        ctx = mp.get_context('spawn')
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        self.pending = {}
+        self.max_pending = max_pending
+        self.worker = ctx.Process(target=_eval_worker, daemon=True,
+                                  args=(config, np.asarray(train_data), np.asarray(val_data), num_threads,
+                                        self.tasks, self.results))
+        self.worker.start()
+    
+    def submit(self, iter_num, model):
+        snapshot = cpu_state_dict(model)
+        self.pending[iter_num] = snapshot
+        self.tasks.put((iter_num, snapshot))
+    
+    def poll(self, block=False):
+        """Finished evaluations so far; block=True waits for every pending snapshot"""
+        done = []
+        while self.pending:
+            try:
+                iter_num, losses = self._next_result(wait=block or len(self.pending) > self.max_pending)
+            except queue.Empty:
+                break
+            if isinstance(losses, Exception):
+                raise RuntimeError(f"Async evaluation of step {iter_num} failed") from losses
+            done.append((iter_num, losses, self.pending.pop(iter_num)))
+        return done
+    
+    def _next_result(self, wait):
+        """Next (iter_num, losses) from the worker; a wait raises instead of hanging if the worker has died"""
+        if not wait:
+            return self.results.get(block=False)
+        while True:
+            alive = self.worker.is_alive()  # checked first: a result put just before exiting is still read below
+            try:
+                return self.results.get(timeout=ASYNC_EVAL_POLL_SECONDS)
+            except queue.Empty:
+                if not alive:
+                    raise RuntimeError(f"Async eval worker exited (code {self.worker.exitcode}) "
+                                       f"with {len(self.pending)} evaluation(s) pending") from None
+    
+    def close(self):
+        self.tasks.put(None)
+        self.worker.join()
+
+def plot_training_curves(eval_steps, train_losses, val_losses, title, path):
+    """Loss curves to a PNG (Figure API, no pyplot state, so it is safe off the main thread)"""
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.plot(eval_steps, train_losses, 'g', label='Train Loss', linewidth=2)
+    ax.plot(eval_steps, val_losses, 'r', label='Val Loss', linewidth=2)
+    ax.set_xlabel('Iteration')
+    ax.set_ylabel('Loss')
+    ax.set_title(title)
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+    fig.savefig(path, dpi=150, bbox_inches='tight')
+
+class CheckpointWriter:
+    """
+    Background thread for checkpoints and plots, so training never waits on disk or matplotlib
+    Files are written to <path>.tmp, fsynced and renamed with os.replace: a crash or power loss mid-save leaves
+    the old file intact
+    Retention: the best checkpoint is overwritten in place, save_last() keeps only the keep_last newest
+    <prefix>_step<N>.pt files per prefix, counting the ones an earlier (resumed) run left on disk
+    """
+    def __init__(self, keep_last=0):
+        self.keep_last = keep_last
+        self.last_paths = {}  # prefix -> its _step<N>.pt paths, oldest first
+        self.error = None
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job[0](*job[1:])
+            except Exception as e:
+                self.error = self.error or e
+    
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Background checkpoint writer failed") from self.error
+    
+    def _write(self, state_dict, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            torch.save(state_dict, f)
+            f.flush()
+            os.fsync(f.fileno())  # the data is on disk before the rename can be
+        os.replace(tmp_path, path)
+        if hasattr(os, 'O_DIRECTORY'):  # POSIX: make the rename itself durable
+            dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+    
+    def _series(self, path):
+        """Rolling path list of path's prefix, seeded from the files on disk (sorted by step) on first use"""
+        prefix = path[:path.rindex('_step')]
+        if prefix not in self.last_paths:
+            steps = {}
+            for existing in glob.glob(f"{glob.escape(prefix)}_step*.pt"):
+                match = re.fullmatch(r'_step(\d+)\.pt', existing[len(prefix):])
+                if match:
+                    steps[existing] = int(match.group(1))
+            self.last_paths[prefix] = sorted(steps, key=steps.get)
+        return self.last_paths[prefix]
+    
+    def _write_last(self, state_dict, path):
+        series = self._series(path)
+        self._write(state_dict, path)
+        if path in series:  # resumed at a step that was already saved
+            series.remove(path)
+        series.append(path)
+        while len(series) > self.keep_last:
+            os.remove(series.pop(0))
+    
+    def save(self, state_dict, path):
+        """Queue an atomic write; state_dict must already be a CPU copy (see cpu_state_dict)"""
+        self._check()
+        self.jobs.put((self._write, state_dict, path))
+    
+    def save_last(self, state_dict, path):
+        """Like save(), for the rolling 'last N' checkpoints (no-op when keep_last == 0)"""
+        if self.keep_last > 0:
+            self._check()
+            self.jobs.put((self._write_last, state_dict, path))
+    
+    def submit(self, fn, *args):
+        """Run any other artifact job (e.g. plot_training_curves) on the writer thread"""
+        self._check()
+        self.jobs.put((fn,) + args)
+    
+    def close(self):
+        """Wait until everything queued is on disk"""
+        self.jobs.put(None)
+        self.thread.join()
+        self._check()
+
 # ============================================================================
 # MAIN TRAINING FUNCTION
 # ============================================================================
 
-def train_slm(config, train_data, val_data, tokenizer):
-    """Main training loop"""
+def train_slm(config, train_data, val_data, tokenizer, resume=False):
+    """
+    Main training loop
+    resume=True continues from the full training state (written every config.checkpoint_interval iterations)
+    """
     
     # Setup device
     device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -238,73 +1007,209 @@ def train_slm(config, train_data, val_data, tokenizer):
     ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
     ctx = nullcontext() if device == 'cpu' else torch.amp.autocast(device_type=device, dtype=ptdtype)
     
+    # Data-parallel on CPU when launched with torchrun: gloo all-reduces the gradients,
+    # rank 0 alone evaluates and writes checkpoints
+    rank, world_size = setup_distributed()
+    if world_size > 1:
+        device, ctx = 'cpu', nullcontext()
+    
+    # CPU mixed precision, only where bf16 is native (checked once here)
+    if device == 'cpu' and config.cpu_bf16:
+        if not cpu_bf16_supported():
+            print("⚠️  cpu_bf16: this CPU has no native bf16 (AVX512-BF16/AMX), training in fp32")
+        ctx = cpu_autocast()
+    
     # Set seed
     torch.manual_seed(config.seed)
     np.random.seed(config.seed)
     
-    # Create model
+    # Full training state of the run being resumed (applied once the model and optimizer exist)
+    ckpt_path, state_path = 'best_tiny_model.pt', 'tiny_model_state.pt'
+    state = None
+    if resume and os.path.exists(state_path):
+        state = torch.load(state_path, map_location=device, weights_only=False)
+    
+    # Create model (a compact vocabulary shrinks wte/lm_head to the ids seen in training)
+    if config.compact_vocab:
+        config = replace(config, vocab_size=tokenizer.n_vocab)
     model = TinyGPT(config).to(device)
+    if config.compact_vocab:
+        model.vocab_map.copy_(tokenizer.vocab_map())
+    
+    # Auto batch sizing, on the bare model: the largest micro-batch within the memory budget
+    # (a resumed run reuses the plan saved with its training state, so it continues bit-for-bit)
+    batch_sizing = None
+    if config.auto_batch_tokens > 0:
+        config, batch_sizing = plan_micro_batches(model, config, device, ctx, world_size,
+                                                  planned=state['config'] if state is not None else None,
+                                                  train_data=train_data, val_data=val_data)
+        model.config = config
+        print(f"📐 Auto batch: {config.batch_size} x {config.gradient_accumulation_steps} accumulation "
+              f"({batch_sizing['tokens_per_step']:,} tokens/step, budget {batch_sizing['budget_mb']:,.0f} MB)")
+        if not batch_sizing['fits']:
+            print(f"⚠️  Auto batch: even one sequence per micro-batch exceeds the {batch_sizing['budget_mb']:,.0f} MB "
+                  f"budget (model, optimizer and data included), training anyway - raise memory_budget_mb")
+    
+    train_model = DDP(model, broadcast_buffers=False) if world_size > 1 else model
+    if config.compile:
+        # Fixed (batch_size, block_size) batches: compiled once, evaluation stays eager
+        enable_compile_cache()
+        train_model = torch.compile(train_model)
     
     # Optimizer and scheduler
-    optimizer = torch.optim.AdamW(model.parameters(), lr=config.learning_rate, 
-                                  betas=(0.9, 0.95), weight_decay=0.1, eps=1e-9)
+    optimizer = make_optimizer(model, config)
     # scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
     scaler = torch.amp.GradScaler(device, enabled=(dtype == 'float16'))
     
     # Training loop
-    train_losses, val_losses = [], []
+    train_losses, val_losses, eval_steps = [], [], []
     best_val_loss = float('inf')
+    start_iter = 0
+    
+    if state is not None:
+        # Everything the next step depends on, so the run continues bit-for-bit
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scaler.load_state_dict(state['scaler'])
+        start_iter = state['iter_num']
+        train_losses, val_losses, eval_steps = state['train_losses'], state['val_losses'], state['eval_steps']
+        best_val_loss = state['best_val_loss']
+        torch.set_rng_state(state['torch_rng'])
+        if state['cuda_rng'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['cuda_rng'])
+        np.random.set_state(state['numpy_rng'])
+        print(f"\n⏯️  Resuming from {state_path} at iteration {start_iter}")
     
-    print(f"\n🚀 Starting training for {config.max_iters} iterations...")
+    print(f"\n🚀 Starting training for {config.max_iters - start_iter} iterations...")
     print(f"   Device: {device}")
+    print(f"   Precision: {'fp32' if isinstance(ctx, nullcontext) else f'{ctx.fast_dtype} autocast, fp32 weights'}")
     print(f"   Model parameters: {model.param_count:,}")
     print(f"   Data/Parameter ratio: {len(train_data)/model.param_count:.6f}")
     
-    for iter_num in tqdm(range(config.max_iters)):
+    # Token buffers and batch tensors are set up once for the whole run
+    train_loader = BatchLoader(train_data, config.block_size, config.batch_size, device)
+    val_loader = BatchLoader(val_data, config.block_size, config.batch_size, device)
+    
+    # Training batches come from their own loader (and RNG) so evaluation never reorders them;
+    # with prefetch_batches > 0 they are prepared in a background thread while the model computes
+    batch_loader = BatchLoader(train_data, config.block_size, config.batch_size, device,
+                               rng=np.random.RandomState(config.seed + rank))  # one RNG stream per rank
+    batch_loader.skip(start_iter)
+    if config.prefetch_batches > 0:
+        batch_loader = BatchPrefetcher(batch_loader, config.max_iters - start_iter, depth=config.prefetch_batches)
+    data_wait_time = 0.0
+    loop_start_time = time.perf_counter()
+    
+    # Checkpoints and plots are written by a background thread (atomic rename, best + last N retention)
+    writer = CheckpointWriter(keep_last=config.keep_last_checkpoints)
+    
+    # Async eval scores a snapshot in a worker process; its results land a few steps later
+    use_async_eval = config.async_eval and rank == 0
+    evaluator = AsyncEvaluator(config, train_data, val_data, config.eval_threads) if use_async_eval else None
+    
+    def record_eval(eval_iter, losses, snapshot=None):
+        nonlocal best_val_loss
+        eval_steps.append(eval_iter)
+        train_losses.append(losses['train'])
+        val_losses.append(losses['val'])
+        
+        val_ppl = f", val ppl {losses['val_perplexity']:.2f}" if 'val_perplexity' in losses else ""
+        print(f"\nStep {eval_iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}{val_ppl}")
+        
+        # Copy the weights only when something is written: no 50257 x n_embd copy on a plain eval
+        improved = losses['val'] < best_val_loss
+        if snapshot is None and (improved or writer.keep_last > 0):
+            snapshot = cpu_state_dict(model)
+        writer.save_last(snapshot, f"{os.path.splitext(ckpt_path)[0]}_step{eval_iter}.pt")
+        if improved:
+            best_val_loss = losses['val']
+            writer.save(snapshot, ckpt_path)
+    
+    def save_training_state(next_iter):
+        if evaluator is not None:
+            for eval_iter, losses, snapshot in evaluator.poll(block=True):  # history must be complete
+                record_eval(eval_iter, losses, snapshot)
+        writer.save({
+            'model': cpu_state_dict(model),
+            'optimizer': cpu_copy(optimizer.state_dict()),
+            'scaler': cpu_copy(scaler.state_dict()),
+            'iter_num': next_iter,
+            'train_losses': list(train_losses),
+            'val_losses': list(val_losses),
+            'eval_steps': list(eval_steps),
+            'best_val_loss': best_val_loss,
+            'torch_rng': torch.get_rng_state(),
+            'cuda_rng': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'numpy_rng': np.random.get_state(),
+            'config': config,
+            'batch_sizing': batch_sizing,
+        }, state_path)
+    
+    for iter_num in tqdm(range(start_iter, config.max_iters), disable=rank > 0):
         # Evaluation
-        if iter_num % config.eval_interval == 0:
-            losses = estimate_loss(model, train_data, val_data, config, device, ctx)
-            train_losses.append(losses['train'])
-            val_losses.append(losses['val'])
-            
-            print(f"\nStep {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-            
-            if losses['val'] < best_val_loss:
-                best_val_loss = losses['val']
-                torch.save(model.state_dict(), 'best_tiny_model.pt')
+        if rank == 0 and iter_num % config.eval_interval == 0:
+            if evaluator is None:
+                record_eval(iter_num, estimate_loss(model, train_loader, val_loader, config, device, ctx))
+            else:
+                evaluator.submit(iter_num, model)
+        if evaluator is not None:
+            for eval_iter, losses, snapshot in evaluator.poll():
+                record_eval(eval_iter, losses, snapshot)
         
         # Training step
-        X, y = get_batch(train_data, config.block_size, config.batch_size, device)
+        batch_start_time = time.perf_counter()
+        X, y = batch_loader.get_batch()
+        data_wait_time += time.perf_counter() - batch_start_time  # large share of the loop = data-bound
         
-        with ctx:
-            logits, loss = model(X, y)
-            loss = loss / config.gradient_accumulation_steps
-        
-        scaler.scale(loss).backward()
+        # Under DDP, gradients are only all-reduced on the last micro-step of an accumulation cycle
+        sync = (iter_num + 1) % config.gradient_accumulation_steps == 0
+        with train_model.no_sync() if world_size > 1 and not sync else nullcontext():
+            with ctx:
+                _, loss = train_model(X, y)
+                loss = loss / config.gradient_accumulation_steps
+            
+            scaler.scale(loss).backward()
         
-        if ((iter_num + 1) % config.gradient_accumulation_steps == 0):
+        if sync:
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
             scaler.step(optimizer)
             scaler.update()
             optimizer.zero_grad(set_to_none=True)
+        
+        # Full training state at accumulation boundaries (and at the end, so a finished run can be extended)
+        next_iter = iter_num + 1
+        if rank == 0 and config.checkpoint_interval > 0 and (next_iter == config.max_iters or (
+                next_iter % config.checkpoint_interval == 0 and next_iter % config.gradient_accumulation_steps == 0)):
+            save_training_state(next_iter)
+    
+    loop_time = time.perf_counter() - loop_start_time
+    tokens_per_sec = (config.max_iters - start_iter) * config.batch_size * config.block_size * world_size / loop_time
+    model.training_stats = {'world_size': world_size, 'loop_time': loop_time,
+                            'tokens_per_sec': tokens_per_sec, 'data_wait_time': data_wait_time,
+                            'batch_sizing': batch_sizing}
+    if rank > 0:
+        writer.close()
+        return model, tokenizer
+    
+    if evaluator is not None:
+        for eval_iter, losses, snapshot in evaluator.poll(block=True):
+            record_eval(eval_iter, losses, snapshot)
+        evaluator.close()
     
     # Final evaluation
-    final_losses = estimate_loss(model, train_data, val_data, config, device, ctx)
+    final_losses = estimate_loss(model, train_loader, val_loader, config, device, ctx)
     print(f"\n✅ Training complete!")
     print(f"   Final train loss: {final_losses['train']:.4f}")
     print(f"   Final val loss: {final_losses['val']:.4f}")
     print(f"   Best val loss: {best_val_loss:.4f}")
+    print(f"   Data wait: {data_wait_time:.2f}s of {loop_time:.2f}s training loop "
+          f"({data_wait_time / loop_time:.1%}, prefetch_batches={config.prefetch_batches})")
+    print(f"   Throughput: {tokens_per_sec:,.0f} tokens/s ({world_size} process(es))")
     
-    # Plot losses
-    plt.figure(figsize=(10, 6))
-    plt.plot(train_losses, 'g', label='Train Loss', linewidth=2)
-    plt.plot(val_losses, 'r', label='Val Loss', linewidth=2)
-    plt.xlabel('Evaluation Steps')
-    plt.ylabel('Loss')
-    plt.title(f'Training Curves (Data: {config.dataset_size} tokens, Params: {model.param_count:,})')
-    plt.legend()
-    plt.grid(True, alpha=0.3)
-    plt.savefig('training_curves.png', dpi=150, bbox_inches='tight')
+    # Plot losses (on the writer thread), then wait for every pending artifact
+    writer.submit(plot_training_curves, eval_steps, train_losses, val_losses,
+                  f'Training Curves (Data: {config.dataset_size} tokens, Params: {model.param_count:,})', 'training_curves.png')
+    writer.close()
     print(f"📊 Training curve saved to: training_curves.png")
     
     return model, tokenizer
@@ -313,24 +1218,105 @@ def train_slm(config, train_data, val_data, tokenizer):
 # INFERENCE FUNCTION
 # ============================================================================
 
-def generate_text(model, tokenizer, prompt, max_tokens=50, temperature=0.8):
-    """Generate text from a prompt"""
+def generate_text(model, tokenizer, prompt, max_tokens=50, temperature=0.8, use_cache=True, window_shift=None,
+                  top_p=None, repetition_penalty=1.0, stop_sequences=None, seed=None, bf16=None):
+    """
+    Generate text from a prompt (KV-cached decoding unless use_cache=False)
+    For generations much longer than block_size pass window_shift (e.g. block_size // 2)
+    top_p, repetition_penalty and seed configure the Sampler (temperature=0 means greedy);
+    stop_sequences (e.g. ["\\n\\n"]) end generation early and are cut from the text
+    bf16: CPU bf16 autocast (None = the model's config.cpu_bf16; fp32 where the CPU lacks native bf16)
+    """
     device = next(model.parameters()).device
     model.eval()
+    tokenizer = CompactVocab.from_model(model, tokenizer)
     
     tokens = tokenizer.encode_ordinary(prompt)
     context = torch.tensor(tokens, dtype=torch.long, device=device).unsqueeze(0)
+    sampler = Sampler(temperature, top_k=40, top_p=top_p, repetition_penalty=repetition_penalty,
+                      seeds=None if seed is None else [seed])
+    stop = StopSequences(tokenizer, stop_sequences) if stop_sequences else None
+    bf16 = getattr(model.config, 'cpu_bf16', False) if bf16 is None else bf16
+    
+    with torch.no_grad(), cpu_autocast(bf16 and device.type == 'cpu'):
+        generated = model.generate(context, max_new_tokens=max_tokens, use_cache=use_cache,
+                                   window_shift=window_shift, sampler=sampler, stop=stop)
+    
+    if stop is None:
+        return tokenizer.decode(generated.squeeze().tolist())
+    return tokenizer.decode(tokens) + stop.truncate(tokenizer.decode(generated[0, len(tokens):].tolist()))
+
+def generate_text_batch(model, tokenizer, prompts, max_tokens=50, temperature=0.8, show_stats=True,
+                        top_p=None, repetition_penalty=1.0, stop_sequences=None, seeds=None, bf16=None):
+    """
+    Generate text for several prompts in one left-padded batch
+    stop_sequences: shared list of strings or one list per prompt; seeds: one int per prompt
+    bf16: CPU bf16 autocast, as in generate_text
+    """
+    model.eval()
+    tokenizer = CompactVocab.from_model(model, tokenizer)
+    prompt_tokens = [tokenizer.encode_ordinary(prompt) for prompt in prompts]
+    sampler = Sampler(temperature, top_k=40, top_p=top_p, repetition_penalty=repetition_penalty, seeds=seeds)
+    stop = StopSequences(tokenizer, stop_sequences) if stop_sequences else None
+    
+    bf16 = getattr(model.config, 'cpu_bf16', False) if bf16 is None else bf16
+    on_cpu = next(model.parameters()).device.type == 'cpu'
+    
+    start_time = time.time()
+    with cpu_autocast(bf16 and on_cpu):
+        new_tokens = model.generate_batch(prompt_tokens, max_new_tokens=max_tokens, stop_token=tokenizer.eot_token,
+                                          sampler=sampler, stop=stop)
+    elapsed = time.time() - start_time
     
-    with torch.no_grad():
-        generated = model.generate(context, max_new_tokens=max_tokens, temperature=temperature, top_k=40)
+    if show_stats:
+        total_tokens = sum(len(t) for t in new_tokens)
+        print(f"⚡ Batched generation: {len(prompts)} prompts, {total_tokens} tokens in {elapsed:.2f}s "
+              f"({total_tokens / elapsed:.1f} tok/s)")
     
-    return tokenizer.decode(generated.squeeze().tolist())
+    if stop is None:
+        return [tokenizer.decode(p + t) for p, t in zip(prompt_tokens, new_tokens)]
+    return [tokenizer.decode(p) + stop.truncate(tokenizer.decode(t), row)
+            for row, (p, t) in enumerate(zip(prompt_tokens, new_tokens))]
+
+def compare_generation_throughput(model, tokenizer, prompts, max_tokens=30, temperature=0.8):
+    """
+    Time the one-prompt-at-a-time loop against a single batched call
+    Neither side stops at eot_token, and each is credited with the new tokens it actually produced
+    """
+    device = next(model.parameters()).device
+    model.eval()
+    tokenizer = CompactVocab.from_model(model, tokenizer)
+    prompt_tokens = [tokenizer.encode_ordinary(prompt) for prompt in prompts]
+    bf16 = getattr(model.config, 'cpu_bf16', False) and device.type == 'cpu'
+    
+    start_time = time.time()
+    sequential_tokens = 0
+    with cpu_autocast(bf16):
+        for tokens in prompt_tokens:
+            context = torch.tensor(tokens, dtype=torch.long, device=device).unsqueeze(0)
+            generated = model.generate(context, max_new_tokens=max_tokens, sampler=Sampler(temperature, top_k=40))
+            sequential_tokens += generated.size(1) - len(tokens)
+    sequential_time = time.time() - start_time
+    
+    start_time = time.time()
+    with cpu_autocast(bf16):
+        new_tokens = model.generate_batch(prompt_tokens, max_new_tokens=max_tokens,
+                                          sampler=Sampler(temperature, top_k=40))
+    batched_time = time.time() - start_time
+    batched_tokens = sum(len(t) for t in new_tokens)
+    
+    print(f"\n⏱️  Generation throughput ({len(prompts)} prompts x {max_tokens} tokens):")
+    print(f"   Sequential: {sequential_tokens / sequential_time:.1f} tok/s "
+          f"({sequential_tokens} tokens in {sequential_time:.2f}s)")
+    print(f"   Batched   : {batched_tokens / batched_time:.1f} tok/s ({batched_tokens} tokens in {batched_time:.2f}s)")
+    print(f"   Speedup   : {(batched_tokens / batched_time) / (sequential_tokens / sequential_time):.2f}x")
+    return sequential_time, batched_time
 
 # ============================================================================
 # EXPERIMENT RUNNER
 # ============================================================================
 
-def run_experiment(sample_text, config, experiment_name="Experiment"):
+def run_experiment(sample_text, config, experiment_name="Experiment", resume=False):
     """Run a complete experiment"""
     print("="*70)
     print(f"🧪 {experiment_name.upper()}")
@@ -340,18 +1326,21 @@ def run_experiment(sample_text, config, experiment_name="Experiment"):
     train_data, val_data, tokenizer = create_tiny_dataset_from_text(sample_text, config)
     
     # Train model
-    model, tokenizer = train_slm(config, train_data, val_data, tokenizer)
+    model, tokenizer = train_slm(config, train_data, val_data, tokenizer, resume=resume)
     
     # Test generation
     print("\n" + "="*70)
     print("📝 GENERATION TESTS")
     print("="*70)
     
-    for prompt in TEST_PROMPTS:
+    outputs = generate_text_batch(model, tokenizer, TEST_PROMPTS, max_tokens=30, temperature=0.8)
+    for prompt, output in zip(TEST_PROMPTS, outputs):
         print(f"\n🔹 Prompt: '{prompt}'")
-        output = generate_text(model, tokenizer, prompt, max_tokens=30, temperature=0.8)
         print(f"   Output: {output}")
     
+    # One prompt at a time vs one batched call, same prompts
+    compare_generation_throughput(model, tokenizer, TEST_PROMPTS, max_tokens=30, temperature=0.8)
+    
     return model, tokenizer
 
 # ============================================================================
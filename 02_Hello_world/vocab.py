@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+vocab.py - Compact Vocabulary for Tiny Models
+Maps the GPT-2 ids that actually occur in the training data onto a dense range, id 0 is UNK
+With n_embd=32 the full 50257-row wte/lm_head dominates both parameters and per-step FLOPs
+"""
+
+import numpy as np
+import torch
+
+UNK_ID = 0
+UNK_TEXT = "<unk>"
+
+# ============================================================================
+# COMPACT VOCABULARY
+# ============================================================================
+
+class CompactVocab:
+    """
+    Drop-in for the tiktoken encoding (encode_ordinary / decode / eot_token / n_vocab) in compact ids
+    token_ids: kept tokenizer ids, compact id i + 1 <-> token_ids[i]; every other id encodes to UNK_ID
+    """
+    def __init__(self, tokenizer, token_ids):
+        self.tokenizer = tokenizer
+        self.token_ids = [int(t) for t in token_ids]
+        self.n_vocab = len(self.token_ids) + 1
+        self.compact_ids = np.full(tokenizer.n_vocab, UNK_ID, dtype=np.int64)
+        self.compact_ids[self.token_ids] = np.arange(1, self.n_vocab)
+        self.eot_token = int(self.compact_ids[tokenizer.eot_token])
+
+    @classmethod
+    def from_tokens(cls, tokenizer, tokens):
+        """Keep every id present in tokens, plus end-of-text so generation can still stop"""
+        return cls(tokenizer, sorted(set(np.unique(tokens).tolist()) | {tokenizer.eot_token}))
+
+    @classmethod
+    def from_model(cls, model, tokenizer):
+        """The vocabulary a model was trained with, or the tokenizer unchanged for full-vocabulary models"""
+        vocab_map = getattr(model, 'vocab_map', None)
+        if vocab_map is None or isinstance(tokenizer, cls):
+            return tokenizer
+        return cls(tokenizer, vocab_map[1:].tolist())
+
+    def vocab_map(self):
+        """Tokenizer id of every compact id (-1 for UNK), stored in the checkpoint as TinyGPT.vocab_map"""
+        return torch.tensor([-1] + self.token_ids, dtype=torch.long)
+
+    def to_compact(self, ids):
+        """Array of tokenizer ids -> array of compact ids"""
+        return self.compact_ids[np.asarray(ids, dtype=np.int64)]
+
+    def encode_ordinary(self, text):
+        return self.to_compact(self.tokenizer.encode_ordinary(text)).tolist()
+
+    def decode(self, ids):
+        """Compact ids -> text, UNK positions render as <unk>"""
+        pieces, run = [], []
+        for i in ids:
+            if i == UNK_ID:
+                pieces += [self.tokenizer.decode(run), UNK_TEXT]
+                run = []
+            else:
+                run.append(self.token_ids[i - 1])
+        pieces.append(self.tokenizer.decode(run))
+        return "".join(pieces)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_optimizers.py - Low-memory Optimizers vs AdamW
+Trains every phase config with optimizer='adamw', 'adamw8bit' and 'factored' from the same seed and reports
+the optimizer state memory of each and the convergence parity (exact full-pass val loss) against AdamW
+"""
+
+import io
+import os
+from contextlib import nullcontext, redirect_stdout
+from dataclasses import replace
+
+import torch
+
+from train import (PHASES, build_token_cache, create_dataset_from_token_cache, train_slm, evaluate_full,
+                   TinyGPT, make_optimizer)
+from optimizers import optimizer_state_bytes
+
+# ============================================================================
+# BENCHMARK CONFIGURATION
+# ============================================================================
+
+DATA_FILE = 'data/training_data.txt'
+OPTIMIZERS = ['adamw', 'adamw8bit', 'factored']
+MAX_ITERS = 200  # per run, capped so the whole table finishes in well under an hour on one core
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def state_mb(config):
+    """Optimizer state after one step on a random batch (AdamW and friends allocate it lazily)"""
+    torch.manual_seed(config.seed)
+    model = TinyGPT(config)
+    optimizer = make_optimizer(model, config)
+    X = torch.randint(0, config.vocab_size, (config.batch_size, config.block_size))
+    _, loss = model(X, X)
+    loss.backward()
+    optimizer.step()
+    return optimizer_state_bytes(optimizer) / 2**20
+
+
+def run_phase(phase_idx):
+    """Train the phase once per optimizer; {optimizer: {'state_mb', 'val_loss'}}"""
+    phase = PHASES[phase_idx]
+    config = replace(phase['config'], max_iters=min(phase['config'].max_iters, MAX_ITERS), checkpoint_interval=0)
+    config = replace(config, eval_interval=config.max_iters)  # one eval at step 0: no mid-run eval cost
+    results = {}
+    for name in OPTIMIZERS:
+        run_config = replace(config, optimizer=name)
+        with redirect_stdout(io.StringIO()):  # train_slm is chatty
+            train_data, val_data, tokenizer = create_dataset_from_token_cache(run_config, DATA_FILE)
+            model, _ = train_slm(run_config, train_data, val_data, tokenizer,
+                                 f"optim_bench_phase{phase_idx}_{name}", f"optim_bench_phase{phase_idx}_{name}")
+            results[name] = {'state_mb': state_mb(run_config),
+                             'val_loss': evaluate_full(model.eval(), val_data, run_config, 'cpu', nullcontext())['loss']}
+    return results
+
+
+def main():
+    print("="*70)
+    print("💾 LOW-MEMORY OPTIMIZERS vs ADAMW")
+    print("="*70)
+    print(f"   Threads: {torch.get_num_threads()}, iterations per run: <= {MAX_ITERS}")
+    os.makedirs('models', exist_ok=True)
+    build_token_cache(DATA_FILE)
+
+    rows = []
+    for phase_idx, phase in enumerate(PHASES):
+        print(f"   Training {phase['name']} ({', '.join(OPTIMIZERS)})...")
+        rows.append((phase_idx, run_phase(phase_idx)))
+
+    print(f"\n{'Phase':<7} {'Optimizer':<11} {'State (MB)':<12} {'Saved':<8} {'Val loss':<10} {'vs AdamW':<9}")
+    print("-"*70)
+    for phase_idx, results in rows:
+        base = results['adamw']
+        for name in OPTIMIZERS:
+            result = results[name]
+            print(f"{phase_idx:<7} {name:<11} {result['state_mb']:<12.1f} "
+                  f"{1 - result['state_mb'] / base['state_mb']:<8.0%} {result['val_loss']:<10.4f} "
+                  f"{result['val_loss'] - base['val_loss']:<+9.4f}")
+    print("="*70)
+    print("   State: optimizer tensors after the first step; val loss: exact full pass over the val split")
+
+
+if __name__ == "__main__":
+    main()
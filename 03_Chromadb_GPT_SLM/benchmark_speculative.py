@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark_speculative.py - Speculative Decoding Benchmark
+Phase 1 model drafts, Phase 4 model verifies; prompt lookup (n-gram) proposals as a draft-free variant
+Reports acceptance rate and end-to-end speedup over plain KV-cached decoding on TEST_PROMPTS
+"""
+
+import time
+import torch
+import tiktoken
+
+from config import CONFIG_MICRO, CONFIG_FULL, TEST_PROMPTS
+from train import load_phase_model, speculative_generate, build_ngram_index, prompt_lookup_generate
+
+# ============================================================================
+# BENCHMARK CONFIGURATION
+# ============================================================================
+
+DRAFT_MODEL = ("phase1_model", CONFIG_MICRO)
+TARGET_MODEL = ("phase4_model", CONFIG_FULL)
+MAX_NEW_TOKENS = 60
+NUM_DRAFT_OPTIONS = [2, 4, 6]
+LOOKUP_DRAFT_OPTIONS = [4, 8, 16]
+TEMPERATURE = 0.8
+TOP_K = 40
+
+# ============================================================================
+# BENCHMARK
+# ============================================================================
+
+def time_baseline(model, contexts, max_new_tokens):
+    """Plain KV-cached decoding with the target model"""
+    start_time = time.time()
+    for context in contexts:
+        model.generate(context, max_new_tokens=max_new_tokens, temperature=TEMPERATURE, top_k=TOP_K)
+    return time.time() - start_time
+
+
+def time_speculative(model, draft_model, contexts, max_new_tokens, num_draft):
+    """Speculative decoding, summing draft/accept counts over all prompts"""
+    drafted, accepted, target_calls = 0, 0, 0
+    start_time = time.time()
+    for context in contexts:
+        _, stats = speculative_generate(model, draft_model, context, max_new_tokens=max_new_tokens,
+                                        num_draft=num_draft, temperature=TEMPERATURE, top_k=TOP_K)
+        drafted += stats['drafted']
+        accepted += stats['accepted']
+        target_calls += stats['target_calls']
+    elapsed = time.time() - start_time
+    return elapsed, accepted / max(drafted, 1), target_calls
+
+
+def time_prompt_lookup(model, ngram_index, contexts, max_new_tokens, num_draft):
+    """Prompt-lookup decoding against the n-gram index of the training corpus"""
+    drafted, accepted, target_calls = 0, 0, 0
+    start_time = time.time()
+    for context in contexts:
+        _, stats = prompt_lookup_generate(model, context, max_new_tokens=max_new_tokens, ngram_index=ngram_index,
+                                          num_draft=num_draft, temperature=TEMPERATURE, top_k=TOP_K)
+        drafted += stats['drafted']
+        accepted += stats['accepted']
+        target_calls += stats['target_calls']
+    elapsed = time.time() - start_time
+    return elapsed, accepted / max(drafted, 1), target_calls
+
+
+def main():
+    torch.manual_seed(1337)
+
+    print("="*70)
+    print("⚡ SPECULATIVE DECODING BENCHMARK")
+    print("="*70)
+
+    draft_model = load_phase_model(*DRAFT_MODEL)
+    model = load_phase_model(*TARGET_MODEL)
+    print(f"   Draft : {DRAFT_MODEL[0]} ({draft_model.param_count:,} params)")
+    print(f"   Target: {TARGET_MODEL[0]} ({model.param_count:,} params)")
+
+    ngram_index = build_ngram_index()
+
+    enc = tiktoken.get_encoding("gpt2")
+    contexts = [torch.tensor(enc.encode_ordinary(prompt), dtype=torch.long).unsqueeze(0)
+                for prompt in TEST_PROMPTS]
+    total_tokens = len(contexts) * MAX_NEW_TOKENS
+
+    with torch.no_grad():
+        # Warm up both models once so the first timed run is not penalized
+        time_speculative(model, draft_model, contexts[:1], 8, NUM_DRAFT_OPTIONS[0])
+        baseline_time = time_baseline(model, contexts, MAX_NEW_TOKENS)
+
+        print(f"\n{'Mode':<18} {'Time (s)':<10} {'Tok/s':<10} {'Accept':<10} {'Target calls':<14} {'Speedup':<8}")
+        print("-"*70)
+        print(f"{'baseline':<18} {baseline_time:<10.2f} {total_tokens / baseline_time:<10.1f} "
+              f"{'-':<10} {total_tokens:<14} {'1.00x':<8}")
+
+        for num_draft in NUM_DRAFT_OPTIONS:
+            elapsed, acceptance_rate, target_calls = time_speculative(
+                model, draft_model, contexts, MAX_NEW_TOKENS, num_draft)
+            print(f"{f'speculative k={num_draft}':<18} {elapsed:<10.2f} {total_tokens / elapsed:<10.1f} "
+                  f"{acceptance_rate:<10.1%} {target_calls:<14} {f'{baseline_time / elapsed:.2f}x':<8}")
+
+        for num_draft in LOOKUP_DRAFT_OPTIONS:
+            elapsed, acceptance_rate, target_calls = time_prompt_lookup(
+                model, ngram_index, contexts, MAX_NEW_TOKENS, num_draft)
+            print(f"{f'lookup k={num_draft}':<18} {elapsed:<10.2f} {total_tokens / elapsed:<10.1f} "
+                  f"{acceptance_rate:<10.1%} {target_calls:<14} {f'{baseline_time / elapsed:.2f}x':<8}")
+
+    print("="*70)
+    print(f"   {len(TEST_PROMPTS)} prompts x {MAX_NEW_TOKENS} new tokens, temperature={TEMPERATURE}, top_k={TOP_K}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ class ExperimentConfig:
     # MODEL ARCHITECTURE
     n_layer: int = 2
     n_head: int = 2
+    n_kv_head: int = 0  # key/value heads shared by the query heads (1 = multi-query, 0 = n_head)
     n_embd: int = 64
     block_size: int = 32
     dropout: float = 0.0  # Reduced dropout for tiny models
@@ -20,10 +21,25 @@ class ExperimentConfig:
     warmup_steps: int = 50
     gradient_accumulation_steps: int = 1
     eval_interval: int = 50
+    prefetch_batches: int = 2  # Batches prepared ahead by a background thread (0 = off)
+    async_eval: bool = False  # Score weight snapshots in a worker process while training continues
+    eval_threads: int = 1  # torch threads for the async eval worker
+    eval_mode: str = 'sampled'  # 'sampled' (random batches) or 'full' (every val token once)
+    eval_batch_size: int = 64  # Windows per forward pass in 'full' eval, independent of batch_size
+    keep_last_checkpoints: int = 0  # Also keep the N most recent eval checkpoints next to the best one
+    checkpoint_interval: int = 200  # Full training state for resuming phases every N iterations (0 = off)
+    compile: bool = False  # torch.compile the training step (first steps pay the compile time)
+    cpu_bf16: bool = False  # bf16 autocast on CPUs with native bf16 (AVX512-BF16/AMX), fp32 weights
+    loss_chunk_tokens: int = 256  # lm_head + cross-entropy in chunks of N tokens, never the full logits (0 = off)
+    activation_checkpointing: int = 0  # recompute every k-th Block in backward instead of storing it (1 = all, 0 = off)
+    auto_batch_tokens: int = 0  # tokens per optimizer step; train_slm then picks batch_size/accumulation (0 = off)
+    memory_budget_mb: int = 0  # peak memory per process allowed to auto batch sizing (0 = 80% of RAM/GPU)
+    optimizer: str = 'adamw'  # 'adamw', or low-memory 'adamw8bit' / 'factored' (see benchmark_optimizers.py)
     
     # MISC
     vocab_size: int = 50257
     seed: int = 42
+    compact_vocab: bool = False  # Train on the token ids present in the data only (see vocab.py)
 
 
 # ============================================================================
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+train_ddp.py - Data-parallel Phase Training on CPU
+N local workers (torchrun, gloo backend) train one phase on the shared token memmap,
+each drawing its own batches; gradients are all-reduced, rank 0 evaluates and checkpoints
+
+    torchrun --standalone --nproc_per_node=4 train_ddp.py --phase 4
+    python train_ddp.py --scaling 1,2,4 --phase 2 --max-iters 200   # scaling efficiency table
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from dataclasses import replace
+
+import torch
+import torch.distributed as dist
+
+from train import (PHASES, build_token_cache, create_dataset_from_token_cache, train_slm, setup_distributed,
+                   available_cores, phase_progress)
+
+# ============================================================================
+# DDP CONFIGURATION
+# ============================================================================
+
+DATA_FILE = 'data/training_data.txt'
+DEFAULT_PHASE = 4
+SCALING_WORLD_SIZES = [1, 2, 4]
+SCALING_MAX_ITERS = 200
+
+# ============================================================================
+# WORKER
+# ============================================================================
+
+def train_worker(phase_idx, max_iters=None, model_name=None, report=None):
+    """
+    One rank: split the cores evenly between the local ranks, train, rank 0 writes the report JSON
+    Also runs as a plain single process (WORLD_SIZE unset), which is the scaling baseline
+    """
+    rank, world_size = setup_distributed()
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, len(available_cores()) // local_world_size))
+
+    phase = PHASES[phase_idx]
+    config = phase['config'] if max_iters is None else replace(phase['config'], max_iters=max_iters)
+    if model_name is None:
+        model_name = phase['model_name']
+        resume = phase_progress(phase)[0] == 'resume'
+    else:
+        config = replace(config, checkpoint_interval=0)  # benchmark runs never leave a training state behind
+        resume = False
+
+    os.makedirs('models', exist_ok=True)
+    if rank == 0:
+        build_token_cache(DATA_FILE)
+    if world_size > 1:
+        dist.barrier()  # the other ranks only ever map the finished cache file
+
+    train_data, val_data, tokenizer = create_dataset_from_token_cache(config, DATA_FILE)
+    model, _ = train_slm(config, train_data, val_data, tokenizer, model_name,
+                         f"{phase['plot_name']}_ddp{world_size}", resume=resume)
+
+    if rank == 0 and report is not None:
+        with open(report, 'w', encoding='utf-8') as f:
+            json.dump({'phase': phase_idx, 'threads_per_rank': torch.get_num_threads(), **model.training_stats}, f)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+# ============================================================================
+# SCALING BENCHMARK
+# ============================================================================
+
+def launch(world_size, phase_idx, max_iters, report):
+    """Run one benchmark: a plain process for world_size 1, torchrun with world_size local workers otherwise"""
+    script = os.path.abspath(__file__)
+    args = ['--phase', str(phase_idx), '--max-iters', str(max_iters),
+            '--model-name', f"{PHASES[phase_idx]['model_name']}_ddp{world_size}", '--report', report]
+    if world_size == 1:
+        command = [sys.executable, script] + args
+    else:
+        command = [sys.executable, '-m', 'torch.distributed.run', '--standalone',
+                   f'--nproc_per_node={world_size}', script] + args
+    subprocess.run(command, check=True)
+    with open(report, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def scaling_benchmark(world_sizes, phase_idx, max_iters):
+    """Train the same phase with each world size; efficiency = tokens/s(N) / (N * tokens/s(1))"""
+    if world_sizes[0] != 1:
+        world_sizes = [1] + world_sizes
+    results = {}
+    for world_size in world_sizes:
+        results[world_size] = launch(world_size, phase_idx, max_iters, f"models/ddp_scaling_{world_size}.json")
+
+    base = results[1]['tokens_per_sec']
+    print("\n" + "="*70)
+    print(f"📈 DDP SCALING - {PHASES[phase_idx]['name']}, {max_iters} iterations, {len(available_cores())} core(s)")
+    print("="*70)
+    print(f"{'Ranks':<8} {'Threads/rank':<14} {'Tokens/s':<12} {'Speedup':<10} {'Efficiency':<10}")
+    print("-"*70)
+    for world_size, stats in results.items():
+        speedup = stats['tokens_per_sec'] / base
+        print(f"{world_size:<8} {stats['threads_per_rank']:<14} {stats['tokens_per_sec']:<12,.0f} "
+              f"{f'{speedup:.2f}x':<10} {speedup / world_size:<10.1%}")
+    print("="*70)
+    print("   Tokens/s counts every rank's batches (global batch = ranks x batch_size)")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data-parallel CPU training of one phase (run under torchrun)")
+    parser.add_argument('--phase', type=int, default=DEFAULT_PHASE, choices=range(len(PHASES)))
+    parser.add_argument('--max-iters', type=int, default=None, help="override the phase's max_iters")
+    parser.add_argument('--model-name', default=None, help="checkpoint name (default: the phase's own, with resume)")
+    parser.add_argument('--report', default=None, help="rank 0 writes throughput stats to this JSON file")
+    parser.add_argument('--scaling', default=None, metavar='1,2,4',
+                        help="launch one run per world size and print the scaling efficiency table")
+    args = parser.parse_args()
+
+    if args.scaling is not None:
+        world_sizes = [int(n) for n in args.scaling.split(',')] if args.scaling else SCALING_WORLD_SIZES
+        scaling_benchmark(world_sizes, args.phase, args.max_iters or SCALING_MAX_ITERS)
+    else:
+        train_worker(args.phase, args.max_iters, args.model_name, args.report)